@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+from pandas import DataFrame
+import pyarrow as pa
+from dask.distributed import Client, Future, get_worker, worker_client
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+"""
+Distribute datasets to the workers of a Dask cluster.
+PUBLISH routes each pickled DataFrame through the scheduler with `publish_dataset()`, and every first use on a
+worker opens a `worker_client()` to fetch it. SCATTER converts the frame to an Arrow table, whose buffers serialize
+without pickling, and scatters it once with `broadcast=True`, so every worker, or every one of the given home
+workers, already holds it. Such a worker then reads it from its own data store, without a client. Only the future is
+published, not the data. It keeps the data alive and lets other workers, e.g. ones that join later, fetch it from
+their peers.
+"""
+class DatasetDistribution:
+    PUBLISH = 'publish'
+    SCATTER = 'scatter'
+
+
+SCATTERED = {}  # On each worker, dataset name to the key of its broadcast data.
+
+
+def register_scattered(keys: dict):
+    SCATTERED.update(keys)
+
+
+def scattered_here(dask_worker=None) -> list:
+    """
+    Run on a worker, with `Client.run()`: the datasets scattered to it.
+    """
+    return [key for key, data_key in SCATTERED.items() if data_key in dask_worker.data]
+
+
+def as_arrow(df: DataFrame) -> pa.Table | DataFrame:
+    try:
+        return pa.Table.from_pandas(df)
+    except (pa.ArrowInvalid, pa.ArrowTypeError) as e:  # E.g. mixed type object columns.
+        logger.warning(f'Cannot convert to Arrow ({e}); scattering the DataFrame.')
+        return df
+
+
+def as_pandas(value) -> DataFrame | None:
+    if isinstance(value, Future):
+        value = value.result()
+    return value.to_pandas() if isinstance(value, pa.Table) else value
+
+
+def distribute_dataset(c: Client, key: str, df: DataFrame, mode: str = DatasetDistribution.SCATTER,
+                       workers: list = None):
+    """
+    :param workers: SCATTER to these worker addresses only; None for every worker.
+    :return: None; a coroutine to await on an asynchronous client.
+    """
+    if c.asynchronous:
+        return distribute_dataset_async(c, key, df, mode, workers)
+    match mode:
+        case DatasetDistribution.PUBLISH:
+            c.publish_dataset(df, name=key)
+        case DatasetDistribution.SCATTER:
+            future = c.scatter(as_arrow(df), workers=workers, broadcast=True, hash=False)
+            c.publish_dataset(future, name=key)
+            c.run(register_scattered, {key: future.key}, workers=workers)
+        case _:
+            raise Exception("Invalid Distribution Mode!")
+
+
+async def distribute_dataset_async(c: Client, key: str, df: DataFrame, mode: str = DatasetDistribution.SCATTER,
+                                   workers: list = None):
+    match mode:
+        case DatasetDistribution.PUBLISH:
+            await c.publish_dataset(df, name=key)
+        case DatasetDistribution.SCATTER:
+            future = await c.scatter(as_arrow(df), workers=workers, broadcast=True, hash=False)
+            await c.publish_dataset(future, name=key)
+            await c.run(register_scattered, {key: future.key}, workers=workers)
+        case _:
+            raise Exception("Invalid Distribution Mode!")
+
+
+def fetch_dataset(key: str) -> DataFrame | None:
+    """
+    Resolve a distributed dataset: from this worker's own data when it was scattered here, otherwise through a client.
+    :return: The DataFrame, or None when nothing is distributed under `key`.
+    """
+    try:
+        worker = get_worker()
+    except ValueError:  # Not on a worker.
+        return as_pandas(Client.current(allow_global=True).get_dataset(name=key, default=None))
+    data_key = SCATTERED.get(key, None)
+    if data_key is not None and data_key in worker.data:
+        return as_pandas(worker.data[data_key])
+    with worker_client() as wc:
+        return as_pandas(wc.get_dataset(name=key, default=None))
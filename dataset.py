@@ -1,15 +1,20 @@
 #!/usr/bin/env python3
 
 import logging
+import time
 import pandas as pd
 from pandas import DataFrame
 import dask
+from dask.base import tokenize
 import dask.dataframe as dd
-from dask.distributed import LocalCluster, Client, worker_client, as_completed, Future
-from google.cloud import bigquery
+from dask.distributed import LocalCluster, Client, as_completed, Future
 from google.oauth2 import service_account
+from table_cache import get_table, query_table, fetch_tables
+from shared_dataset import share_dataset
+from cluster_dataset import DatasetDistribution, distribute_dataset, fetch_dataset
 import sqlalchemy as sa
-from EMS.manager import Databases, get_gbq_credentials
+from EMS.manager import get_gbq_credentials
+from sinks import get_sink
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -30,15 +35,26 @@ TABLE_NAMES = {  # URL to GBQ table name map.
     'https://www.kaggle.com/c/higgs-boson/test': 'XYZ.higgs_boson_test',
 }
 
+def call_with_params(instance: callable, params: dict) -> DataFrame:
+    return instance(**params)
+
+
 class EvalOnCluster(object):
 
     def __init__(self, client: Client,
                  table_name: str, credentials: service_account.credentials = None):
-        self.db = Databases(table_name, None, credentials, None)
+        # `RESULT_SINK` selects the destination; without a table the results are discarded.
+        self.db = get_sink(f'EMS.{table_name}', credentials, spec='null' if table_name is None else None)
         self.client = client
         self.credentials = credentials
         self.computations = None  # Iterable returning (future, df).
         self.keys = None
+        self.pending = {}  # Dask key to (future, param key) of the computations in flight.
+
+    def key_from_params(self, params: dict) -> tuple:
+        if self.keys is None:
+            self.keys = sorted(params.keys())
+        return tuple(params[k] for k in self.keys)
 
     def eval_params(self, instance: callable, params: dict) -> tuple:
         """
@@ -47,25 +63,69 @@ class EvalOnCluster(object):
         :param params: The `kwargs` to be passed to the `instance`
         :return: A tuple of param values suitable to become a key in a dict.
         """
+        return self.eval_many(instance, [params])[0]
 
-        if self.keys is None:
-            self.keys = sorted(params.keys())
-        futures = self.client.map(lambda p: instance(**p), [params])  # To isolate kwargs, use a lambda function.
+    def eval_many(self, instance: callable, params_list: list) -> list:
+        """
+        Evaluate the instance with each params in one submission. Dask keys are deterministic, a token of the instance
+        and the params, so a duplicate, in the list or still in flight, is computed once and yields one result.
+        :return: The tuples of param values, as from `eval_params()`, in order.
+        """
+        keys, submit = [], {}
+        for params in params_list:
+            keys.append(self.key_from_params(params))
+            dask_key = f'{instance.__name__}-{tokenize(instance, sorted(params.items()))}'
+            if dask_key not in self.pending and dask_key not in submit:
+                submit[dask_key] = (params, keys[-1])
+        if len(submit) == 0:
+            return keys
+        futures = self.client.map(call_with_params, [instance] * len(submit), [p for p, _ in submit.values()],
+                                  key=list(submit.keys()))
+        for future, (dask_key, (_, key)) in zip(futures, submit.items()):
+            self.pending[dask_key] = (future, key)
         if self.computations is None:
             self.computations = as_completed(futures, with_results=True)
         else:
             self.computations.update(futures)
-        return tuple(params[k] for k in self.keys)
+        return keys
+
+    def retire(self, batch: list) -> list:
+        """
+        Write a batch of completed computations to the database in one push and release them.
+        :return: (DataFrame, key) for each computation.
+        """
+        results = []
+        for future, result in batch:
+            _, key = self.pending.pop(future.key)
+            future.release()  # EP function; release the data; will not be reused.
+            results.append((result, key))
+        self.db.write(pd.concat([df for df, _ in results], ignore_index=True))
+        return results
 
     def result(self) -> (DataFrame, tuple):  # Return a DataFrame and a key.
-        future, result = next(self.computations)
-        self.db.push(result)
-        future.release()  # EP function; release the data; will not be reused.
-        values = result[self.keys].to_numpy()
-        yield result, tuple(v for v in values[0])
+        """
+        Yield the next batch of completed computations, waiting for at least one.
+        """
+        if self.computations is not None and not self.computations.is_empty():
+            yield from self.retire(self.computations.next_batch(block=True))
+
+    def __iter__(self):
+        """
+        Yield (DataFrame, key) until no computation is in flight, including those submitted while iterating.
+        Completed computations are drained from `as_completed` in batches.
+        """
+        while self.computations is not None and not self.computations.is_empty():
+            yield from self.retire(self.computations.next_batch(block=True))
+
+    async def __aiter__(self):
+        while self.computations is not None and not self.computations.is_empty():
+            batch = [await self.computations.__anext__()]
+            batch.extend(self.computations.next_batch(block=False))
+            for df, key in self.retire(batch):
+                yield df, key
 
     def final_push(self):
-        self.db.final_push()
+        self.db.close()
         self.client.shutdown()
 
 
@@ -79,16 +139,23 @@ def on_worker() -> bool:
         return False
 
 
-def get_dataset(key: str) -> DataFrame:
-    if on_worker():
-        with worker_client() as wc:
-            df = wc.get_dataset(name=key, default=None)
-    else:
-        wc = Client.current(allow_global=True)
-        df = wc.get_dataset(name=key, default=None)
-    if df is not None:
-        return df.copy(deep=True)  # Defend against mutating common data.
-    return None
+DATASETS = {}
+
+
+def get_dataset(key: str, read_only: bool = True) -> DataFrame:
+    """
+    Fetch a distributed dataset once per worker into node shared, memory-mapped, read-only buffers.
+    :param read_only: Return a shallow copy of the shared frame: its buffers are the zero-copy, read-only views, while
+    adding, replacing or dropping its columns stays private to the caller. Otherwise a private deep copy.
+    """
+    df = DATASETS.get(key, None)
+    if df is None:
+        df = fetch_dataset(key)  # From this worker's own data when scattered; no `worker_client()`.
+        if df is None:
+            return None
+        df = share_dataset(key, df)
+        DATASETS[key] = df
+    return df.copy(deep=not read_only)  # Never the cached frame itself; a trial may restructure its own.
 
 
 def experiment(*, key: str) -> DataFrame:
@@ -100,18 +167,44 @@ def experiment(*, key: str) -> DataFrame:
     return DataFrame(data={'key': key, 'transfer_succeeded': df is not None}, index=[0])
 
 
-def get_df_from_gbq(table_name, credentials: service_account.credentials = None):
-    client = bigquery.Client(credentials=credentials)
-    query = f"SELECT * FROM `{table_name}`"
-    df = client.query(query).to_dataframe()
-    return df
+def get_df_from_gbq(table_name, credentials: service_account.credentials = None, cache: bool = True):
+    if cache:  # Serve from the local on-disk cache; query GBQ only on a miss.
+        return get_table(table_name, credentials)
+    return query_table(table_name, credentials)
 
 
-def push_tables_to_cluster(tables: dict, c: Client, credentials: service_account.credentials = None):
-    for key, table in tables.items():
-        df = get_df_from_gbq(table, credentials)
-        c.publish_dataset(df, name=key)
-        logger.info(f'{key}\n{df}')
+def push_tables_to_cluster(tables: dict, c: Client, credentials: service_account.credentials = None,
+                           concurrent: bool = True, mode: str = DatasetDistribution.SCATTER) -> dict:
+    """
+    Fetch the tables, concurrently by default, and distribute each one to the cluster as soon as it arrives.
+    :param mode: A `DatasetDistribution`; SCATTER broadcasts Arrow tables to every worker, PUBLISH pickles the
+    frames through the scheduler.
+    :return: Per table statistics: rows, bytes, fetch and publish seconds; a coroutine returning them on
+    an asynchronous client.
+    """
+    if c.asynchronous:
+        return push_tables_to_cluster_async(tables, c, credentials, concurrent, mode)
+    stats = {}
+    for key, table, df, fetch_seconds in fetch_tables(tables, credentials, workers=8 if concurrent else 1):
+        start_time = time.time()
+        distribute_dataset(c, key, df, mode)
+        stats[key] = {'table': table, 'rows': len(df), 'bytes': int(df.memory_usage(deep=True).sum()),
+                      'fetch_seconds': fetch_seconds, 'publish_seconds': time.time() - start_time}
+        logger.info(f'{key}: {stats[key]}')
+    return stats
+
+
+async def push_tables_to_cluster_async(tables: dict, c: Client, credentials: service_account.credentials = None,
+                                       concurrent: bool = True, mode: str = DatasetDistribution.SCATTER) -> dict:
+    stats = {}
+    # The fetches block the event loop; nothing else runs yet.
+    for key, table, df, fetch_seconds in fetch_tables(tables, credentials, workers=8 if concurrent else 1):
+        start_time = time.time()
+        await distribute_dataset(c, key, df, mode)
+        stats[key] = {'table': table, 'rows': len(df), 'bytes': int(df.memory_usage(deep=True).sum()),
+                      'fetch_seconds': fetch_seconds, 'publish_seconds': time.time() - start_time}
+        logger.info(f'{key}: {stats[key]}')
+    return stats
 
 
 def push_to_dataset(c: Client) -> str:
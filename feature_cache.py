@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+import os
+import hashlib
+import threading
+from pathlib import Path
+import numpy as np
+import scipy.sparse as sp
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+"""
+Per-worker, and optionally on-disk, cache of encoded feature matrices.
+A dataset's encoding depends only upon its URL, so it is computed once per worker, not once per trial.
+Entries are keyed by (url, ENCODING_VERSION, encoding, token): the encoding is the dataset's `StudyENCODING` and the
+token a hash of its content, so a refreshed table is encoded afresh. Bump the version whenever
+`normalize_dataset()`, `category_encode()` or the target encoding changes. Set `$FEATURE_CACHE_DIR` to also keep
+the encodings on disk, shared by every worker and run on the filesystem.
+An entry is a dict: X, a C-contiguous float32 matrix or a float32 SciPy CSR matrix; y, int64 labels or float targets;
+num_classes; obj_type; classes, the label names; columns, the feature names; and categorical, the indices of the
+columns holding category codes. The arrays are read-only; trials share them.
+A build holds its key's lock, so concurrent worker threads wait for one encoding rather than each building their own
+and doubling the worker's peak memory.
+"""
+ENCODING_VERSION = 3
+FEATURE_CACHE_DIR = 'FEATURE_CACHE_DIR'
+FEATURES = {}
+LOCKS = {}  # Key to the lock held while its features are built.
+lock = threading.Lock()
+
+
+def feature_path(url: str, version: int, encoding: str = None, token: str = None) -> Path | None:
+    root = os.environ.get(FEATURE_CACHE_DIR, None)
+    if root is None:
+        return None
+    digest = hashlib.sha256(f'{url}\n{version}\n{encoding}\n{token}'.encode()).hexdigest()[:16]
+    return Path(root).expanduser() / f'features-{digest}.npz'
+
+
+def freeze_features(features: dict) -> dict:
+    for v in features.values():
+        for a in (v.data, v.indices, v.indptr) if sp.issparse(v) else (v,):
+            if isinstance(a, np.ndarray):
+                a.setflags(write=False)
+    return features
+
+
+def save_features(features: dict, path: Path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f'{path.stem}.{os.getpid()}.tmp.npz')
+    arrays = {k: np.asarray(v) for k, v in features.items() if not sp.issparse(v)}
+    X = features['X']
+    if sp.issparse(X):  # Store the CSR components.
+        arrays.update(X_data=X.data, X_indices=X.indices, X_indptr=X.indptr, X_shape=np.array(X.shape))
+    np.savez(tmp, **arrays)  # Uncompressed; fast to load.
+    os.replace(tmp, path)
+
+
+def load_features(path: Path) -> dict:
+    with np.load(path, allow_pickle=False) as npz:
+        features = {k: npz[k] for k in npz.files}
+    if 'X_data' in features:
+        features['X'] = sp.csr_matrix((features.pop('X_data'), features.pop('X_indices'), features.pop('X_indptr')),
+                                      shape=tuple(features.pop('X_shape')))
+    features['num_classes'] = int(features['num_classes'])
+    features['obj_type'] = str(features['obj_type'])
+    return features
+
+
+def get_features(url: str, build: callable, version: int = ENCODING_VERSION, encoding: str = None,
+                 token: str = None) -> dict:
+    """
+    Return the encoded features for `url`, building them with `build()` only on a miss.
+    :param build: Returns the features dict for `url`, encoded with `encoding`.
+    :param token: Identifies the dataset's content, e.g. `shared_dataset.content_token()`.
+    """
+    key = (url, version, encoding, token)
+    features = FEATURES.get(key, None)
+    if features is not None:
+        return features
+    with lock:
+        key_lock = LOCKS.setdefault(key, threading.Lock())
+    with key_lock:
+        features = FEATURES.get(key, None)
+        if features is None:  # Not built by another thread while this one waited.
+            features = FEATURES[key] = build_features(url, build, version, encoding, token)
+    return features
+
+
+def build_features(url: str, build: callable, version: int, encoding: str = None, token: str = None) -> dict:
+    path = feature_path(url, version, encoding, token)
+    if path is not None and path.exists():
+        logger.info(f'Feature cache hit: {url} <- {path}')
+        features = load_features(path)
+    else:
+        features = build()
+        X = features['X']
+        features['X'] = X.astype(np.float32).tocsr() if sp.issparse(X) else np.ascontiguousarray(X, dtype=np.float32)
+        if path is not None:
+            save_features(features, path)
+    return freeze_features(features)
@@ -1,8 +1,15 @@
 #!/usr/bin/env python3
 
 import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.feather as feather
 from EMS.manager import get_gbq_credentials
+from rank_one import to_wide
+from sinks import get_sink
 import sys
 import logging
 
@@ -14,30 +21,112 @@ def parse() -> tuple:
     parser = argparse.ArgumentParser(prog='gather_csv_to_gbq')
     parser.add_argument('table_name', type=str)
     parser.add_argument('files', type=str, nargs='*')
+    parser.add_argument('--wide', action='store_true', help='Expand packed `ve` vectors into `veNNN` columns.')
+    parser.add_argument('--stream', action='store_true', help='Read concurrently and upload in bounded chunks.')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--chunk_rows', type=int, default=10000)
     args = parser.parse_args()
-    return args.table_name, args.files
+    return args.table_name, args.files, args.wide, args.stream, args.workers, args.chunk_rows
+
+
+def is_arrow_file(file: str) -> bool:
+    return file.endswith(('.parquet', '.feather', '.arrow'))
+
+
+def read_arrow_table(file: str) -> pa.Table:
+    """
+    Read a Parquet or Feather (Arrow IPC) result file through a memory map; no text parsing is involved.
+    """
+    if file.endswith('.parquet'):
+        return pq.read_table(file, memory_map=True)
+    return feather.read_table(file, memory_map=True)
 
 
 def concat_csv_to_df(files: list) -> pd.DataFrame:
+    if len(files) > 0 and all(is_arrow_file(f) for f in files):  # Combine as Arrow; convert to pandas once.
+        return pa.concat_tables([read_arrow_table(f) for f in files]).to_pandas()
     dfs = []
     for f in files:
-        dfs.append(pd.read_csv(f))
+        dfs.append(read_arrow_table(f).to_pandas() if is_arrow_file(f) else pd.read_csv(f))
     df = pd.concat(dfs)
     df.reset_index(drop=True, inplace=True)
     return df
 
 
-def df_to_gbq(df: pd.DataFrame, table_name: str):
+def result_dtypes(file: str) -> dict:
+    """
+    The result schema is known: integer keys, a packed `ve` string if present, and float metrics otherwise.
+    Read only the header of one file to name the columns.
+    """
+    columns = pd.read_csv(file, nrows=0).columns
+    ints = {'nrow', 'ncol', 'seed'}
+    return {c: 'int64' if c in ints else 'string' if c == 've' else 'float64' for c in columns}
+
+
+def read_result_csv(file: str, dtypes: dict) -> pd.DataFrame:
+    if is_arrow_file(file):
+        return read_arrow_table(file).to_pandas()
+    return pd.read_csv(file, engine='pyarrow', dtype=dtypes)
+
+
+def iter_csv_chunks(files: list, workers: int = 8, chunk_rows: int = 10000):
+    """
+    Read the files concurrently and yield DataFrames of at least `chunk_rows` rows, the last one excepted.
+    At most `2 * workers` files are read ahead, so memory is bounded by the chunk size and not the experiment.
+    """
+    if len(files) == 0:
+        return
+    csv_files = [f for f in files if not is_arrow_file(f)]
+    dtypes = result_dtypes(csv_files[0]) if csv_files else None
+    with ThreadPoolExecutor(max_workers=workers) as pool:  # The pyarrow parser releases the GIL.
+        pending = deque()
+        files = iter(files)
+        for f in files:
+            pending.append(pool.submit(read_result_csv, f, dtypes))
+            if len(pending) >= 2 * workers:
+                break
+        dfs, rows = [], 0
+        while pending:
+            df = pending.popleft().result()
+            f = next(files, None)
+            if f is not None:
+                pending.append(pool.submit(read_result_csv, f, dtypes))
+            dfs.append(df)
+            rows += len(df)
+            if rows >= chunk_rows:
+                yield pd.concat(dfs, ignore_index=True)
+                dfs, rows = [], 0
+        if dfs:
+            yield pd.concat(dfs, ignore_index=True)
+
+
+def df_to_gbq(df: pd.DataFrame, table_name: str, cred=None):
+    if cred is None:
+        cred = get_gbq_credentials('stanford-stats-285-donoho-0dc233389eb9.json')
+    with get_sink(f'HW5.{table_name}', cred, batch_rows=len(df)) as sink:  # `RESULT_SINK` selects the destination.
+        sink.write(df)
+
+
+def stream_csv_to_gbq(files: list, table_name: str, wide: bool = False, workers: int = 8, chunk_rows: int = 10000) -> int:
     cred = get_gbq_credentials('stanford-stats-285-donoho-0dc233389eb9.json')
-    df.to_gbq(f'HW5.{table_name}',
-              if_exists='append',
-              progress_bar=False,
-              credentials=cred)
+    rows = 0
+    for df in iter_csv_chunks(files, workers=workers, chunk_rows=chunk_rows):
+        if wide:
+            df = to_wide(df)
+        df_to_gbq(df, table_name, cred)
+        rows += len(df)
+        logging.info(f'Pushed {rows} rows to {table_name}.')
+    return rows
 
 
 def concat_csv_to_gbq() -> pd.DataFrame:
-    table_name, files = parse()
+    table_name, files, wide, stream, workers, chunk_rows = parse()
+    if stream:
+        stream_csv_to_gbq(files, table_name, wide=wide, workers=workers, chunk_rows=chunk_rows)
+        return None
     df = concat_csv_to_df(files)
+    if wide:
+        df = to_wide(df)
     df_to_gbq(df, table_name)
     return df
 
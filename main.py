@@ -4,62 +4,79 @@ import os
 import time
 import argparse
 import numpy as np
-import pandas as pd
 from pandas import DataFrame
 from dask.distributed import Client, LocalCluster
 from dask_jobqueue import SLURMCluster
-from EMS.manager import do_on_cluster, get_gbq_credentials
+from EMS.manager import get_gbq_credentials
+from scheduler import do_on_cluster_windowed
+from memo_cache import memo_cache
+from thread_budget import thread_budget, push_thread_budget
+from rank_one import SVDMethod, ResultFormat, generate_data, generate_data_batch, top_singular_triplet, \
+    check_svd_methods, result_frame
 import logging
 
 logging.basicConfig(level=logging.INFO)
 
-# Function that generates data with noise; will use again in later homeworks
-def generate_data(nrow: int, ncol: int, seed: int = 0) -> tuple:
-
-    # Set seed
-    rng = np.random.default_rng(1 + seed * 10000)  # Ensure the seed is non-zero and spans a large range of values.
+def experiment(*, nrow: int, ncol: int, seed: int, method: str = SVDMethod.FULL,
+               result_format: str = ResultFormat.WIDE) -> DataFrame:
+    start_time = time.time()
+    thread_budget()  # Caps BLAS to this worker slot's share of the cores.
 
-    # Create length-n vector u with element equal to (-1)^i/sqrt(n)
-    u = np.array([(-1)**i/np.sqrt(nrow) for i in range(nrow)])
-    v = np.array([(-1)**(i+1)/np.sqrt(ncol) for i in range(ncol)])
+    X, u_true, v_true, signal_true = generate_data(nrow, ncol, seed=seed)
 
-    # Generate signal
-    signal = 3 * np.outer(u,v)
+    # Analyze the data using SVD; only the leading singular vector is needed.
+    u_est, s_est, v_est = top_singular_triplet(X, method=method, seed=seed)
 
-    # noise matrix of normal(0,1)
-    noise = rng.normal(0,1,(nrow,ncol))/np.sqrt(nrow*ncol)
+    # Calculate alignment between v_est and v_true
+    v_align = np.inner(v_est,v_true)
 
-    # observations matrix
-    X = signal + noise
+    # Save u_est, v_est, u_true, v_true in a CSV file with an index column
+    d = {'nrow': nrow, 'ncol': ncol, 'seed': seed, "v_alignment": v_align}
+    df = result_frame(d, v_est, result_format)
 
-    return X, u, v, signal  # return data
+    # Print runtime
+    logging.info(f"Seed: {seed}; {time.time() - start_time} seconds.")
+    return df
 
 
-def experiment(*, nrow: int, ncol: int, seed: int) -> DataFrame:
+def experiment_batch(*, nrow: int, ncol: int, seed_block: int, block_size: int, size: int,
+                     method: str = SVDMethod.FULL, result_format: str = ResultFormat.WIDE) -> DataFrame:
+    """
+    Run the seeds `[seed_block * block_size, min((seed_block + 1) * block_size, size))` as one stacked solve.
+    The scheduling and serialization cost is paid once per block instead of once per seed.
+    :return: One row per seed with the same schema as `experiment()`.
+    """
     start_time = time.time()
+    thread_budget()  # Caps BLAS to this worker slot's share of the cores.
+    seeds = list(range(seed_block * block_size, min((seed_block + 1) * block_size, size)))
 
-    X, u_true, v_true, signal_true = generate_data(nrow, ncol, seed=seed)
-
-    # Analyze the data using SVD
-    U, S, Vh = np.linalg.svd(X)
+    X, u_true, v_true, signal_true = generate_data_batch(nrow, ncol, seeds)
 
-    v_est = Vh[0,:]
+    # Analyze the (batch, nrow, ncol) tensor with one stacked SVD.
+    u_est, s_est, v_est = top_singular_triplet(X, method=method, seed=seeds)
 
     # Calculate alignment between v_est and v_true
-    v_align = np.inner(v_est,v_true)
+    v_align = v_est @ v_true
 
-    # Save u_est, v_est, u_true, v_true in a CSV file with an index column
-    d = {'nrow': nrow, 'ncol': ncol, 'seed': seed, "v_alignment": v_align}
-    d.update({f've{i:0>3}': ve for i, ve in enumerate(v_est)})
-    df = pd.DataFrame(data=d, index=[0])
+    d = {'nrow': nrow, 'ncol': ncol, 'seed': seeds, "v_alignment": v_align}
+    df = result_frame(d, v_est, result_format)
 
     # Print runtime
-    logging.info(f"Seed: {seed}; {time.time() - start_time} seconds.")
+    logging.info(f"Seeds: {seeds[0]}-{seeds[-1]}; {time.time() - start_time} seconds.")
     return df
 
 
-def build_params(size: int = 1, su_id: str = 'su_ID') -> dict:
+def build_params(size: int = 1, su_id: str = 'su_ID', block_size: int = None) -> dict:
 
+    if block_size is not None and size > 1:  # Dispatch whole blocks of seeds to `experiment_batch()`.
+        return dict(table_name=f'stats285_{su_id}_hw5_{size}_blocks',
+                    params=[{
+                        'nrow': [1000],
+                        'ncol': [1000],
+                        'seed_block': list(range(-(-size // block_size))),
+                        'block_size': [block_size],
+                        'size': [size]
+                    }])
     match size:
         case 1:
             exp = dict(table_name=f'stats285_{su_id}_hw5_{size}_blocks',
@@ -78,32 +95,63 @@ def build_params(size: int = 1, su_id: str = 'su_ID') -> dict:
     return exp
 
 
-def do_cluster_experiment(size: int = 1, su_id: str = 'su_ID', credentials=None):
-    exp = build_params(size=size, su_id=su_id)
+RESULT_KEYS = ['nrow', 'ncol', 'seed']
+
+
+def result_keys(params: dict) -> list:
+    """
+    :return: The `RESULT_KEYS` of each row a trial writes; a block writes one row per seed.
+    """
+    if 'seed_block' in params:
+        block, block_size = params['seed_block'], params['block_size']
+        seeds = range(block * block_size, min((block + 1) * block_size, params['size']))
+    else:
+        seeds = [params['seed']]
+    return [(params['nrow'], params['ncol'], seed) for seed in seeds]
+
+
+def do_cluster_experiment(size: int = 1, su_id: str = 'su_ID', credentials=None, block_size: int = None,
+                          resume: bool = False):
+    exp = build_params(size=size, su_id=su_id, block_size=block_size)
+    instance = experiment if block_size is None or size == 1 else experiment_batch
     with SLURMCluster(cores=8, memory='4GiB', processes=1, walltime='00:15:00') as cluster:
         cluster.scale(8)
         logging.info(cluster.job_script())
         with Client(cluster) as client:
-            do_on_cluster(exp, experiment, client, credentials=credentials)
+            push_thread_budget(client)
+            do_on_cluster_windowed(exp, instance, client, credentials=credentials,
+                                   resume=resume, key_columns=RESULT_KEYS, trial_keys=result_keys,
+                                   memo=memo_cache())
         cluster.scale(0)
 
 
-def do_local_experiment(size: int = 1, su_id: str = 'su_ID', credentials=None):
-    exp = build_params(size=size, su_id=su_id)
+def do_local_experiment(size: int = 1, su_id: str = 'su_ID', credentials=None, block_size: int = None,
+                        resume: bool = False):
+    exp = build_params(size=size, su_id=su_id, block_size=block_size)
+    instance = experiment if block_size is None or size == 1 else experiment_batch
     with LocalCluster() as cluster:
         with Client(cluster) as client:
-            do_on_cluster(exp, experiment, client, credentials=credentials)
+            push_thread_budget(client)
+            do_on_cluster_windowed(exp, instance, client, credentials=credentials,
+                                   resume=resume, key_columns=RESULT_KEYS, trial_keys=result_keys,
+                                   memo=memo_cache())
 
 
 if __name__ == "__main__":
     # Parse the argument passed to this function that is either "local" or "cluster"
     parser = argparse.ArgumentParser()
     parser.add_argument("--type", help="type", type=str, default="local")
-    type = parser.parse_args().type
+    parser.add_argument("--resume", help="skip the trials already in the table", action="store_true")
+    args = parser.parse_args()
+    type = args.type
 
-    if type == "local":
+    if type == "check":
+        check_svd_methods()
+    elif type == "local":
         do_local_experiment(size=1000, su_id=f'{os.environ.get("TABLE_NAME", "su_ID")}_slurm_large_node_gbq_2',
-                            credentials=get_gbq_credentials('stanford-stats-285-donoho-0dc233389eb9.json'))
+                            credentials=get_gbq_credentials('stanford-stats-285-donoho-0dc233389eb9.json'),
+                            resume=args.resume)
     elif type == "cluster":
         do_cluster_experiment(size=1000, su_id=f'{os.environ.get("TABLE_NAME", "su_ID")}_slurm_cluster_2',
-                              credentials=get_gbq_credentials('stanford-stats-285-donoho-0dc233389eb9.json'))
+                              credentials=get_gbq_credentials('stanford-stats-285-donoho-0dc233389eb9.json'),
+                              resume=args.resume)
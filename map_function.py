@@ -6,50 +6,30 @@ import sys
 import numpy as np
 import pandas as pd
 from pandas import DataFrame
-from google.oauth2 import service_account
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.feather as feather
 from EMS.manager import get_gbq_credentials
+from uploader import BackgroundUploader
+from sinks import get_sink
+from rank_one import SVDMethod, ResultFormat, generate_data, top_singular_triplet, result_frame, result_schema
 import argparse
 import logging
 
 logging.basicConfig(level=logging.INFO)
 
 
-# Function that generates data with noise; will use again in later homeworks
-def generate_data(nrow: int, ncol: int, seed: int = 0) -> tuple:
-
-    # Set seed
-    rng = np.random.default_rng(1 + seed * 10000)  # Ensure the seed is non-zero and spans a large range of values.
-
-    # Create length-n vector u with element equal to (-1)^i/sqrt(n)
-    u = np.array([(-1)**i/np.sqrt(nrow) for i in range(nrow)])
-    v = np.array([(-1)**(i+1)/np.sqrt(ncol) for i in range(ncol)])
-
-    # Generate signal
-    signal = 3 * np.outer(u,v)
-
-    # noise matrix of normal(0,1)
-    noise = rng.normal(0,1,(nrow,ncol))/np.sqrt(nrow*ncol)
-
-    # observations matrix
-    X = signal + noise
-
-    return X, u, v, signal  # return data
-
-
-def experiment(*, nrow: int, ncol: int, seed: int) -> DataFrame:
+def experiment(*, nrow: int, ncol: int, seed: int, method: str = SVDMethod.FULL,
+               result_format: str = ResultFormat.WIDE) -> DataFrame:
     start_time = time.time()
 
     X, u_true, v_true, signal_true = generate_data(nrow, ncol, seed=seed)
 
-    # Analyze the data using SVD
-    U, S, Vh = np.linalg.svd(X)
-
-    # Using first singular vector of U and V to estimate signal
-    u_est = U[:,0]
-    v_est = Vh[0,:]
+    # Analyze the data using SVD; using first singular vector of U and V to estimate signal
+    u_est, s_est, v_est = top_singular_triplet(X, method=method, seed=seed)
 
     # Calculate estimate of signal
-    signal_est = S[0] * np.outer(u_est,v_est)
+    signal_est = s_est * np.outer(u_est,v_est)
 
     # Calculate alignment between u_est and u_true
     u_align = np.inner(u_est,u_true)
@@ -61,8 +41,7 @@ def experiment(*, nrow: int, ncol: int, seed: int) -> DataFrame:
     signal_error = np.linalg.norm(signal_est-signal_true)/np.sqrt(nrow*ncol)
 
     d = {'nrow': nrow, 'ncol': ncol, 'seed': seed, "v_alignment": v_align}
-    d.update({f've{i:0>3}': ve for i, ve in enumerate(v_est)})
-    df = pd.DataFrame(data=d, index=[0])
+    df = result_frame(d, v_est, result_format)
 
     # Print runtime
     logging.info(f"Seed: {seed}; {time.time() - start_time} seconds.")
@@ -76,45 +55,57 @@ def parse() -> tuple:
     parser.add_argument('ncol', type=int)
     parser.add_argument('task_id', type=int)
     parser.add_argument('table_name', type=str)
+    parser.add_argument('--method', type=str, default=SVDMethod.FULL,
+                        choices=[SVDMethod.FULL, SVDMethod.ECONOMY, SVDMethod.ARPACK, SVDMethod.RANDOMIZED])
+    parser.add_argument('--format', type=str, default=ResultFormat.WIDE,
+                        choices=[ResultFormat.WIDE, ResultFormat.BINARY, ResultFormat.LIST])
+    parser.add_argument('--output', type=str, default='csv', choices=['csv', 'parquet', 'feather'])
     args = parser.parse_args()
-    return args.nrow, args.ncol, args.task_id, args.table_name
-
-
-def write_to_gbq(task_id: int, table_name: str, results: list, credentials: service_account.Credentials):
-    if len(results) > 0:
-        df = pd.concat(results)
-        if task_id > 0:  # Delay every write except the first.
-            time.sleep(np.random.randint(15, 30))
-        df.to_gbq(f'HW5.{table_name}',
-                  if_exists='append',
-                  progress_bar=False,
-                  credentials=credentials)
+    if args.format == ResultFormat.LIST and args.output == 'csv':
+        parser.error('--format list needs --output parquet or feather.')
+    return args.nrow, args.ncol, args.task_id, args.table_name, args.method, args.format, args.output
 
 
 def do_sbatch_array_to_gbq():
-    nrow, ncol, task_id, table_name = parse()
+    nrow, ncol, task_id, table_name, method, result_format, _ = parse()
     cred = get_gbq_credentials('stanford-stats-285-donoho-0dc233389eb9.json')
 
-    results =[]
-    for s in range(task_id, task_id + 100):
-        results.append(experiment(nrow=nrow, ncol=ncol, seed=s))
-        i = s - task_id
-        if not(i % 50) and i > 0:  # Make 2 writes to the DB.
-            write_to_gbq(task_id, table_name, results, cred)
-            results = []
-    write_to_gbq(task_id, table_name, results, cred)
+    # Uploads proceed in the background; collisions between array tasks are retried with jittered backoff.
+    # The destination is chosen by the `RESULT_SINK` environment variable; BigQuery by default.
+    with get_sink(f'HW5.{table_name}', cred, batch_rows=1) as sink:  # The uploader does the batching.
+        with BackgroundUploader(sink.write, max_rows=50) as uploader:
+            for s in range(task_id, task_id + 100):
+                uploader.push(experiment(nrow=nrow, ncol=ncol, seed=s, method=method, result_format=result_format))
+
+
+def write_results(df: DataFrame, path: str, output: str, ncol: int, result_format: str):
+    """
+    Write one task's results as CSV text, or as zstd compressed Parquet/Feather (Arrow IPC) with a fixed schema.
+    """
+    match output:
+        case 'csv':
+            df.to_csv(path, index=False)
+        case 'parquet':
+            table = pa.Table.from_pandas(df, schema=result_schema(ncol, result_format), preserve_index=False)
+            pq.write_table(table, path, compression='zstd')
+        case 'feather':
+            table = pa.Table.from_pandas(df, schema=result_schema(ncol, result_format), preserve_index=False)
+            feather.write_feather(table, path, compression='zstd')
+        case _:
+            raise Exception("Invalid Output Format!")
 
 
 def do_sbatch_array_to_csv():
-    nrow, ncol, task_id, table_name = parse()
+    nrow, ncol, task_id, table_name, method, result_format, output = parse()
 
     results =[]
     for s in range(task_id, task_id + 100):
-        results.append(experiment(nrow=nrow, ncol=ncol, seed=s))
+        results.append(experiment(nrow=nrow, ncol=ncol, seed=s, method=method, result_format=result_format))
     df = pd.concat(results)
     df.reset_index(drop=True, inplace=True)
-    logging.info(f'{os.getcwd()}/{os.environ.get("TABLE_NAME", table_name)}_{task_id:0>3}.csv')
-    df.to_csv(f'{os.getcwd()}/{os.environ.get("TABLE_NAME", table_name)}_{task_id:0>3}.csv', index=False)
+    path = f'{os.getcwd()}/{os.environ.get("TABLE_NAME", table_name)}_{task_id:0>3}.{output}'
+    logging.info(path)
+    write_results(df, path, output, ncol, result_format)
     # logging.info(f'{os.getcwd()}/{table_name}_{task_id:0>3}.csv')
     # df.to_csv(f'{os.getcwd()}/{table_name}_{task_id:0>3}.csv', index=False)
 
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import types
+import hashlib
+import inspect
+import marshal
+from pathlib import Path
+from pandas import DataFrame
+import pyarrow as pa
+import pyarrow.parquet as pq
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+"""
+Persistent memoization of trial results, so repeated sweeps and drivers do not recompute identical trials.
+An entry is keyed by the fingerprint of the trial function and its canonicalized params. The fingerprint hashes
+the function's source and, transitively, the source of the functions and classes it uses from this repository,
+plus the immutable constants and defaults it reads. The fingerprint does not see module level dicts and lists, which
+may be state rather than configuration, e.g. `DATASET_ENCODINGS`. It does not see the input data or the modules
+outside the repository, e.g. the boosters, either. A driver must fold everything it knows of these into the
+`salt`. The XYZ drivers salt with the dataset encodings, objectives and content tokens; change the salt after
+upgrading a booster.
+Set `$MEMO_CACHE_DIR` to enable the cache. Each entry is one Parquet file. When the directory grows beyond
+`$MEMO_CACHE_MB`, 2048 by default, the least recently used entries are evicted.
+The drivers consult the cache before dispatch and fill it as results arrive; the workers never touch it.
+"""
+MEMO_CACHE_DIR = 'MEMO_CACHE_DIR'
+MEMO_CACHE_MB = 'MEMO_CACHE_MB'
+SCALARS = (bool, int, float, str, bytes, type(None))
+
+
+def is_constant(value) -> bool:
+    if isinstance(value, (tuple, frozenset)):
+        return all(is_constant(v) for v in value)
+    return isinstance(value, SCALARS)
+
+
+def code_source(obj) -> bytes:
+    try:
+        return inspect.getsource(obj).encode()
+    except (OSError, TypeError):  # E.g. defined in a notebook or at the prompt.
+        code = getattr(obj, '__code__', None)
+        return marshal.dumps(code) if code is not None else repr(obj).encode()
+
+
+def fingerprint(fn: callable, salt: str = '') -> str:
+    """
+    :return: A hash of `fn` and of the repository code and constants it reaches.
+    """
+    while hasattr(fn, 'func'):  # functools.partial
+        fn = fn.func
+    root = Path(inspect.getfile(fn)).resolve().parent
+    digest = hashlib.sha256(salt.encode())
+    seen = set()
+
+    def in_repo(obj) -> bool:
+        try:
+            return Path(inspect.getfile(obj)).resolve().parent == root
+        except TypeError:  # Builtins.
+            return False
+
+    def names(code: types.CodeType):
+        yield from code.co_names
+        for const in code.co_consts:  # Nested functions, lambdas and comprehensions.
+            if isinstance(const, types.CodeType):
+                yield from names(const)
+
+    def visit(obj):
+        if id(obj) in seen:
+            return
+        seen.add(id(obj))
+        digest.update(f'{obj.__module__}.{obj.__qualname__}\n'.encode())
+        digest.update(code_source(obj))
+        functions = [obj] if inspect.isfunction(obj) else \
+            [f for f in vars(obj).values() if inspect.isfunction(f)]
+        for f in functions:
+            defaults = (f.__defaults__ or ()) + tuple(sorted((f.__kwdefaults__ or {}).items()))
+            if is_constant(defaults):
+                digest.update(repr(defaults).encode())
+            for name in sorted(set(names(f.__code__))):
+                value = f.__globals__.get(name, None)
+                if (inspect.isfunction(value) or inspect.isclass(value)) and in_repo(value):
+                    visit(value)
+                elif is_constant(value) and not name.startswith('__'):
+                    digest.update(f'{name}={value!r}\n'.encode())
+
+    visit(fn)
+    return digest.hexdigest()[:32]
+
+
+def canonical_params(params: dict) -> str:
+    def plain(v):
+        return v.item() if hasattr(v, 'item') else str(v)  # NumPy scalars.
+    return json.dumps(params, sort_keys=True, default=plain)
+
+
+class MemoCache(object):
+
+    def __init__(self, root: str, max_mb: float = 2048., salt: str = ''):
+        self.root = Path(root).expanduser()
+        self.max_bytes = int(max_mb * 2 ** 20)
+        self.salt = salt
+        self.fingerprints = {}
+        self.hits, self.misses = 0, 0
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.bytes = sum(p.stat().st_size for p in self.root.glob('*/*.parquet'))
+
+    def path(self, fn: callable, params: dict) -> Path:
+        fp = self.fingerprints.get(fn, None)
+        if fp is None:
+            fp = self.fingerprints[fn] = fingerprint(fn, self.salt)
+        digest = hashlib.sha256(f'{fp}\n{canonical_params(params)}'.encode()).hexdigest()[:32]
+        return self.root / fp[:16] / f'{digest}.parquet'
+
+    def get(self, fn: callable, params: dict) -> DataFrame | None:
+        path = self.path(fn, params)
+        try:
+            df = pq.read_table(path).to_pandas()
+            os.utime(path)  # Recently used.
+        except (FileNotFoundError, pa.ArrowInvalid):  # Missing, or evicted or torn by another driver.
+            self.misses += 1
+            return None
+        self.hits += 1
+        return df
+
+    def put(self, fn: callable, params: dict, df: DataFrame):
+        path = self.path(fn, params)
+        try:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+        except (pa.ArrowInvalid, pa.ArrowTypeError) as e:  # E.g. mixed type object columns.
+            logger.warning(f'Cannot memoize {params}: {e}')
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(f'.{os.getpid()}.tmp')
+        pq.write_table(table, tmp)
+        os.replace(tmp, path)
+        self.bytes += path.stat().st_size
+        if self.bytes > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache is at 90% of its budget.
+        """
+        entries = []
+        for p in self.root.glob('*/*.parquet'):
+            try:
+                st = p.stat()
+            except FileNotFoundError:  # Evicted by another driver.
+                continue
+            entries.append((st.st_mtime, st.st_size, p))
+        entries.sort()
+        self.bytes = sum(size for _, size, _ in entries)
+        evicted = 0
+        for _, size, p in entries:
+            if self.bytes <= 0.9 * self.max_bytes:
+                break
+            p.unlink(missing_ok=True)
+            self.bytes -= size
+            evicted += 1
+        logger.info(f'Memo cache: evicted {evicted} entries; {self.bytes / 2 ** 20:.0f} MiB.')
+
+    def split(self, fn: callable, trials, hit: callable):
+        """
+        :param hit: Called with each cached result, e.g. to write it to the sink.
+        :return: Yields the trials that are not cached, lazily.
+        """
+        for params in trials:
+            df = self.get(fn, params)
+            if df is None:
+                yield params
+            else:
+                hit(df)
+
+
+def memo_cache(salt: str = '') -> MemoCache | None:
+    """
+    :param salt: Everything, beyond the function and its params, the results depend upon.
+    :return: The cache in `$MEMO_CACHE_DIR`, or None when it is not set.
+    """
+    root = os.environ.get(MEMO_CACHE_DIR, None)
+    if root is None:
+        return None
+    return MemoCache(root, float(os.environ.get(MEMO_CACHE_MB, 2048.)), salt=salt)
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+
+import time
+import base64
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from pandas import DataFrame
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=8)
+def rank_one_signal(nrow: int, ncol: int) -> tuple:
+    """
+    The deterministic part of the experiment depends only upon the shape; compute it once per shape.
+    The cached arrays are shared by every caller and are therefore read-only.
+    :return: A tuple of (u, v, signal).
+    """
+    # Create length-n vector u with element equal to (-1)^i/sqrt(n)
+    u = np.where(np.arange(nrow) % 2 == 0, 1., -1.) / np.sqrt(nrow)
+    v = np.where(np.arange(ncol) % 2 == 0, -1., 1.) / np.sqrt(ncol)
+
+    # Generate signal
+    signal = 3 * np.outer(u, v)
+    for a in (u, v, signal):
+        a.setflags(write=False)
+    return u, v, signal
+
+
+# Function that generates data with noise; will use again in later homeworks
+def generate_data(nrow: int, ncol: int, seed: int = 0, out: np.ndarray = None) -> tuple:
+    """
+    Generate the observations matrix X = signal + noise.
+    The noise is drawn directly into a single (nrow, ncol) buffer and the cached signal is added in place.
+    :param out: Optional preallocated float64 (nrow, ncol) buffer to hold X; reuse it across seeds.
+    :return: A tuple of (X, u, v, signal). u, v and signal are read-only.
+    """
+    # Set seed
+    rng = np.random.default_rng(1 + seed * 10000)  # Ensure the seed is non-zero and spans a large range of values.
+
+    u, v, signal = rank_one_signal(nrow, ncol)
+
+    # noise matrix of normal(0,1), then the observations matrix
+    X = np.empty((nrow, ncol)) if out is None else out
+    rng.standard_normal(out=X)
+    X /= np.sqrt(nrow * ncol)
+    X += signal
+
+    return X, u, v, signal  # return data
+
+
+def generate_data_batch(nrow: int, ncol: int, seeds: list) -> tuple:
+    """
+    Stack one observations matrix per seed into a (batch, nrow, ncol) tensor.
+    Each slice is identical to `generate_data(nrow, ncol, seed=seed)`.
+    :return: A tuple of (X, u, v, signal). u, v and signal are shared by every slice and are read-only.
+    """
+    X = np.empty((len(seeds), nrow, ncol))
+    for x, seed in zip(X, seeds):
+        generate_data(nrow, ncol, seed=seed, out=x)
+    u, v, signal = rank_one_signal(nrow, ncol)
+    return X, u, v, signal
+
+
+class SVDMethod:
+    """
+    Decomposition backends for the rank-one experiment. Only the leading singular triplet is ever used.
+    FULL: `np.linalg.svd(X)`, the reference.
+    ECONOMY: `np.linalg.svd(X, full_matrices=False)`.
+    ARPACK: Lanczos top-k via `scipy.sparse.linalg.svds`.
+    RANDOMIZED: Randomized range finder with power iterations (Halko, Martinsson & Tropp).
+    """
+    FULL = 'full'
+    ECONOMY = 'economy'
+    ARPACK = 'arpack'
+    RANDOMIZED = 'randomized'
+
+
+def randomized_svd(X: np.ndarray, k: int = 1, oversample: int = 5, n_iter: int = 4, seed=0) -> tuple:
+    """
+    Randomized top-k SVD. X may be a single matrix or a (batch, nrow, ncol) stack.
+    :param seed: An int for a single matrix; a sequence of ints, one per matrix, for a stack.
+    """
+    shape = (X.shape[-1], k + oversample)
+    if X.ndim == 2:
+        omega = np.random.default_rng(seed).standard_normal(shape)
+    else:
+        omega = np.stack([np.random.default_rng(s).standard_normal(shape) for s in seed])
+    Xt = np.swapaxes(X, -1, -2)
+    Q, _ = np.linalg.qr(X @ omega)
+    for _ in range(n_iter):  # Power iterations, re-orthonormalized for stability.
+        Q, _ = np.linalg.qr(Xt @ Q)
+        Q, _ = np.linalg.qr(X @ Q)
+    Ub, S, Vh = np.linalg.svd(np.swapaxes(Q, -1, -2) @ X, full_matrices=False)
+    return (Q @ Ub)[..., :k], S[..., :k], Vh[..., :k, :]
+
+
+def canonical_sign(u: np.ndarray, v: np.ndarray) -> tuple:
+    """
+    Singular vectors are defined only up to a joint sign flip, and each backend picks its own. Flip u and v together
+    so the largest magnitude entry of u is positive, as scikit-learn's `svd_flip()` does. The sign then follows X,
+    not the backend. This is not LAPACK's convention, so it changes the sign of stored results; it is opt in.
+    """
+    i = np.argmax(np.abs(u), axis=-1)
+    sign = np.sign(np.take_along_axis(u, i[..., None], axis=-1))
+    sign[sign == 0] = 1.
+    return u * sign, v * sign
+
+
+def top_singular_triplet(X: np.ndarray, method: str = SVDMethod.FULL, seed=0, canonical: bool = False) -> tuple:
+    """
+    Estimate the leading singular triplet of X.
+    Stacked (batch, nrow, ncol) inputs are solved in one LAPACK call by the FULL, ECONOMY and RANDOMIZED backends.
+    :param X: The observations matrix or a stack of them.
+    :param method: One of the `SVDMethod` values.
+    :param seed: Seeds the randomized backend, one per matrix for a stack; ignored by the others.
+    :param canonical: Flip the signs of u_est and v_est with `canonical_sign()`. Off by default, so the FULL backend
+    returns exactly what `np.linalg.svd()` does and new rows match the historical tables.
+    :return: A tuple of (u_est, s_est, v_est), each with a leading batch axis for a stack.
+    """
+    match method:
+        case SVDMethod.FULL:
+            U, S, Vh = np.linalg.svd(X)
+        case SVDMethod.ECONOMY:
+            U, S, Vh = np.linalg.svd(X, full_matrices=False)
+        case SVDMethod.ARPACK:
+            from scipy.sparse.linalg import svds
+
+            if X.ndim > 2:  # ARPACK has no batched driver.
+                triplets = [top_singular_triplet(x, method=method, canonical=canonical) for x in X]
+                return tuple(np.stack(t) for t in zip(*triplets))
+            U, S, Vh = svds(X, k=1, solver='arpack')  # svds() returns ascending singular values.
+            U, S, Vh = U[:, ::-1], S[::-1], Vh[::-1, :]
+        case SVDMethod.RANDOMIZED:
+            U, S, Vh = randomized_svd(X, k=1, seed=seed)
+        case _:
+            raise Exception("Invalid SVD Method!")
+    u, v = U[..., :, 0], Vh[..., 0, :]
+    if canonical:
+        u, v = canonical_sign(u, v)
+    return u, S[..., 0], v
+
+
+class ResultFormat:
+    """
+    How the estimated vector is stored in a result row.
+    WIDE: One float column per element, `ve000`...`ve999`; the historical schema.
+    BINARY: One string column `ve` holding the base64 encoded little-endian float32 vector; safe for CSV and GBQ.
+    LIST: One column `ve` holding a float32 array per row; stored as an Arrow list by Parquet/Feather.
+    """
+    WIDE = 'wide'
+    BINARY = 'binary'
+    LIST = 'list'
+
+
+def result_frame(d: dict, v_est: np.ndarray, result_format: str = ResultFormat.WIDE, prefix: str = 've') -> DataFrame:
+    """
+    Build the result rows from scalar metrics and the estimated vectors.
+    :param d: Column name to scalar or per-row values, in column order.
+    :param v_est: One vector or a (rows, ncol) matrix of them.
+    :return: A DataFrame with the columns of `d` followed by the vector in `result_format`.
+    """
+    v_est = np.atleast_2d(v_est)
+    match result_format:
+        case ResultFormat.WIDE:
+            df = pd.DataFrame(data=v_est, columns=[f'{prefix}{i:0>3}' for i in range(v_est.shape[1])])
+        case ResultFormat.BINARY:
+            v = np.ascontiguousarray(v_est, dtype='<f4')
+            df = pd.DataFrame(data={prefix: [base64.b64encode(r.tobytes()).decode('ascii') for r in v]})
+        case ResultFormat.LIST:
+            df = pd.DataFrame(data={prefix: list(v_est.astype(np.float32))})
+        case _:
+            raise Exception("Invalid Result Format!")
+    for i, (k, v) in enumerate(d.items()):
+        df.insert(i, k, v)
+    return df
+
+
+def unpack_vectors(column: pd.Series) -> np.ndarray:
+    """
+    Decode a `ResultFormat.BINARY` or `ResultFormat.LIST` column into a (rows, ncol) float32 matrix.
+    Raw bytes, as returned for a GBQ BYTES column, are accepted too.
+    """
+    if len(column) == 0:
+        return np.empty((0, 0), dtype=np.float32)
+    first = column.iloc[0]
+    if isinstance(first, str):
+        buf = b''.join(base64.b64decode(x) for x in column)
+    elif isinstance(first, (bytes, bytearray)):
+        buf = b''.join(column)
+    else:
+        return np.stack([np.asarray(x, dtype=np.float32) for x in column])
+    return np.frombuffer(buf, dtype='<f4').reshape(len(column), -1)
+
+
+def to_wide(df: DataFrame, prefix: str = 've') -> DataFrame:
+    """
+    Reconstruct the historical wide view, one `veNNN` column per element, from a packed result frame.
+    Frames that are already wide are returned unchanged.
+    """
+    if prefix not in df.columns:
+        return df
+    v = unpack_vectors(df[prefix]).astype(np.float64)
+    wide = pd.DataFrame(data=v, columns=[f'{prefix}{i:0>3}' for i in range(v.shape[1])], index=df.index)
+    return pd.concat([df.drop(columns=prefix), wide], axis=1)
+
+
+def result_schema(ncol: int, result_format: str = ResultFormat.WIDE, prefix: str = 've') -> pa.Schema:
+    """
+    The fixed Arrow schema of the rows built by `result_frame()`, used when writing Parquet/Feather.
+    """
+    fields = [('nrow', pa.int64()), ('ncol', pa.int64()), ('seed', pa.int64()), ('v_alignment', pa.float64())]
+    match result_format:
+        case ResultFormat.WIDE:
+            fields += [(f'{prefix}{i:0>3}', pa.float64()) for i in range(ncol)]
+        case ResultFormat.BINARY:
+            fields += [(prefix, pa.string())]
+        case ResultFormat.LIST:
+            fields += [(prefix, pa.list_(pa.float32(), ncol))]  # Fixed size list.
+        case _:
+            raise Exception("Invalid Result Format!")
+    return pa.schema(fields)
+
+
+def check_svd_methods(nrow: int = 1000, ncol: int = 1000, seeds: list = range(5),
+                      methods: list = (SVDMethod.ECONOMY, SVDMethod.ARPACK, SVDMethod.RANDOMIZED),
+                      tol: float = 1e-6) -> DataFrame:
+    """
+    Compare the `v_alignment` of each fast backend against the full SVD, seed by seed.
+    Singular vectors are only defined up to sign, so alignments are compared in absolute value.
+    :param tol: Largest acceptable absolute difference in `v_alignment`.
+    :return: One row per (seed, method) with the alignment, its error against the full SVD and the runtime.
+    """
+    rows = []
+    X = np.empty((nrow, ncol))
+    for seed in seeds:
+        X, u_true, v_true, signal_true = generate_data(nrow, ncol, seed=seed, out=X)
+        for method in (SVDMethod.FULL, *methods):
+            start_time = time.time()
+            _, _, v_est = top_singular_triplet(X, method=method, seed=seed)
+            rows.append({'seed': seed, 'method': method, 'seconds': time.time() - start_time,
+                         'v_alignment': abs(np.inner(v_est, v_true))})
+    df = pd.DataFrame(rows)
+    full = df[df['method'] == SVDMethod.FULL].set_index('seed')['v_alignment']
+    df['error'] = (df['v_alignment'] - df['seed'].map(full)).abs()
+    df['ok'] = df['error'] <= tol
+    logger.info(f'{df.groupby("method")[["seconds", "error"]].max()}')
+    if not df['ok'].all():
+        logger.warning(f'SVD backends disagree with the full SVD:\n{df[~df["ok"]]}')
+    return df
@@ -5,6 +5,7 @@ import os
 import pandas as pd
 from google.oauth2 import service_account
 from EMS.manager import get_gbq_credentials
+from sinks import get_sink
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -14,10 +15,8 @@ def read_csv_to_gbq(path: str, table_name: str, credentials: service_account.cre
     exp_path = os.path.expanduser(path)
     df = pd.read_csv(exp_path)
     logger.info(f'{df}')
-    df.to_gbq(table_name,
-              if_exists='replace',
-              progress_bar=False,
-              credentials=credentials)
+    with get_sink(table_name, credentials, batch_rows=len(df), replace=True) as sink:
+        sink.write(df)
 
 
 if __name__ == "__main__":
@@ -4,6 +4,7 @@ import logging
 from ucimlrepo import fetch_ucirepo, list_available_datasets
 from google.oauth2 import service_account
 from EMS.manager import get_gbq_credentials
+from sinks import get_sink
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -12,10 +13,9 @@ logger = logging.getLogger(__name__)
 def copy_dataset_to_XYZ(dataset_id: int, table_name: str, credentials: service_account.credentials = None):
     repo = fetch_ucirepo(id=dataset_id)
     logger.info(f'{repo}')
-    repo.data.original.to_gbq(table_name,
-                              if_exists='replace',
-                              progress_bar=False,
-                              credentials=credentials)
+    df = repo.data.original
+    with get_sink(table_name, credentials, batch_rows=len(df), replace=True) as sink:
+        sink.write(df)
 
 
 if __name__ == "__main__":
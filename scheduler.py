@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import math
+import time
+import itertools
+from collections import defaultdict
+from pathlib import Path
+import numpy as np
+from pandas import DataFrame
+from dask.distributed import Client, as_completed
+from google.oauth2 import service_account
+from sinks import Sink, get_sink
+from memo_cache import MemoCache
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+"""
+Longest-first scheduling front end to `EMS.manager.do_on_cluster()`.
+Each trial's cost is estimated from its parameters by a log-linear `CostModel`; trials are submitted most expensive
+first, with matching Dask priorities, so the slow trials start early and the sweep does not end with a few
+stragglers while the rest of the cluster idles. The model is refit from every completed trial's measured seconds
+and saved to `$COST_MODEL_DIR`, by default `~/.cache/stats285/cost_models`, so later sweeps start from it.
+Dispatch is windowed: grid points are generated lazily and only `per_thread` tasks per worker thread are in flight;
+each result is released as soon as it is written, so driver and scheduler memory do not grow with the sweep.
+Trials can also be grouped, e.g. by dataset URL, and each group pinned, loosely, to its own set of home workers,
+preferring the workers that already hold the group's dataset. `plan_homes()` places the groups before any dataset
+is distributed, so the driver can scatter each dataset to its group's home workers only; a worker then holds and
+encodes only its own groups' datasets, not every one. A batch cluster's workers join over minutes, so the driver
+first waits for them with `await_workers()`; the workers that join later are homed, as the window sees them, with
+the group that has the most estimated cost left per home worker, and fetch its dataset from their peers.
+With `resume`, the keys already in the destination table are read first and the trials whose results are all
+there are not dispatched, so an interrupted sweep picks up where it stopped. With a `MemoCache`, trials computed
+by any earlier sweep are written from the cache instead of being dispatched.
+"""
+COST_MODEL_DIR = 'COST_MODEL_DIR'
+
+
+def cost_model_path(name: str) -> Path:
+    return Path(os.environ.get(COST_MODEL_DIR, '~/.cache/stats285/cost_models')).expanduser() / f'{name}.json'
+
+
+class CostModel(object):
+    """
+    log(seconds) = features · coef. The coefficients are ridge regressed toward the prior ones, so a handful of
+    completed trials refine, rather than replace, the prior.
+    """
+
+    def __init__(self, prior: dict, ridge: float = 1., path: Path = None):
+        """
+        :param prior: Feature name to prior coefficient map; include a constant 'bias' feature.
+        :param path: Load from, and `save()` to, this JSON file.
+        """
+        self.names = sorted(prior.keys())
+        self.prior = np.array([prior[n] for n in self.names], dtype=float)
+        self.ridge = ridge
+        self.path = path
+        self.xtx = np.zeros((len(self.names), len(self.names)))
+        self.xty = np.zeros(len(self.names))
+        self.count = 0
+        if path is not None and path.exists():
+            saved = json.loads(path.read_text())
+            if saved['names'] == self.names:
+                self.xtx, self.xty, self.count = np.array(saved['xtx']), np.array(saved['xty']), saved['count']
+                logger.info(f'Cost model: {path}, {self.count} trials.')
+        self.coef = self.fit()
+
+    def fit(self) -> np.ndarray:
+        ridge = self.ridge * np.eye(len(self.names))
+        return np.linalg.solve(self.xtx + ridge, self.xty + ridge @ self.prior)
+
+    def vector(self, features: dict) -> np.ndarray:
+        return np.array([features.get(n, 0.) for n in self.names], dtype=float)
+
+    def estimate(self, features: dict) -> float:
+        """
+        :return: Estimated seconds.
+        """
+        return float(np.exp(self.vector(features) @ self.coef))
+
+    def update(self, features: dict, seconds: float):
+        x = self.vector(features)
+        self.xtx += np.outer(x, x)
+        self.xty += x * np.log(max(seconds, 1e-3))
+        self.count += 1
+        self.coef = self.fit()
+
+    def save(self):
+        if self.path is None:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(f'.{os.getpid()}.tmp')
+        tmp.write_text(json.dumps({'names': self.names, 'xtx': self.xtx.tolist(), 'xty': self.xty.tolist(),
+                                   'count': self.count, 'coef': self.coef.tolist()}))
+        os.replace(tmp, self.path)
+
+
+def iter_params(exp: dict):
+    """
+    :return: Yields one kwargs dict per trial, lazily, the product of each `exp['params']` grid.
+    """
+    for grid in exp['params']:
+        keys = list(grid.keys())
+        for values in itertools.product(*(grid[k] for k in keys)):
+            yield dict(zip(keys, values))
+
+
+def unroll_params(exp: dict) -> list:
+    return list(iter_params(exp))
+
+
+def param_names(exp: dict) -> list:
+    return sorted({k for grid in exp['params'] for k in grid.keys()})
+
+
+def pending_filter(db: Sink, key_columns: list, trial_keys: callable) -> callable:
+    """
+    :param key_columns: The result columns that identify a completed trial.
+    :param trial_keys: Maps a trial's params to the `key_columns` tuples of the rows it writes.
+    :return: A predicate, True for trials with any result missing from `db`.
+    """
+    done = db.read_keys(key_columns)
+    logger.info(f'Resume: {len(done)} completed keys in {db.table_name}.')
+
+    def pending(params: dict) -> bool:
+        return not all(k in done for k in trial_keys(params))
+    return pending
+
+
+def resume_filter(exp: dict, db: Sink, key_columns: list = None, trial_keys: callable = None) -> callable:
+    """
+    By default a trial is keyed by its own params, which must then be columns of its result rows.
+    """
+    if key_columns is None:
+        key_columns = param_names(exp)
+    if trial_keys is None:
+        trial_keys = lambda params: [tuple(params[c] for c in key_columns)]
+    return pending_filter(db, key_columns, trial_keys)
+
+
+def timed_instance(instance: callable, params: dict) -> (DataFrame, float):
+    start_time = time.time()
+    df = instance(**params)
+    return df, time.time() - start_time
+
+
+def scheduler_workers(client: Client) -> dict:
+    try:
+        return client.scheduler_info(n_workers=-1)['workers']  # Newer schedulers list only 5 by default.
+    except TypeError:
+        return client.scheduler_info()['workers']
+
+
+def await_workers(client: Client, n_workers: int, timeout: float = 600., quorum: float = 0.5):
+    """
+    Wait up to `timeout` seconds for `n_workers` workers, e.g. the jobs a `SLURMCluster` was scaled to; after that,
+    for a `quorum` fraction of them, at least one, as long as it takes.
+    """
+    try:
+        client.wait_for_workers(n_workers, timeout=timeout)
+    except TimeoutError:
+        need = max(1, math.ceil(quorum * n_workers))
+        logger.warning(f'{len(scheduler_workers(client))} of {n_workers} workers after {timeout:.0f} seconds; '
+                       f'waiting for {need}.')
+        client.wait_for_workers(need)
+    logger.info(f'{len(scheduler_workers(client))} workers.')
+
+
+def run_windowed(client: Client, submit: callable, items, per_thread: int = 2, refresh_seconds: float = 10.,
+                 on_workers: callable = None):
+    """
+    Submit `submit(item)` for each item, keeping at most `per_thread` futures in flight per worker thread.
+    The window follows the cluster as workers join and leave. The thread count is a scheduler round trip, so it is
+    re-read at most every `refresh_seconds`, not on every completion.
+    :param items: Any iterable, consumed lazily.
+    :param on_workers: Called with the scheduler's workers each time they are re-read, before submitting.
+    :return: Yields (item, result) as each completes; the future is released once the consumer resumes.
+    """
+    items = iter(items)
+    futures = {}
+    window = {'size': 0, 'checked': -np.inf}
+
+    def top_up() -> list:
+        if time.monotonic() - window['checked'] >= refresh_seconds:
+            workers = scheduler_workers(client)
+            if on_workers is not None:
+                on_workers(workers)
+            threads = sum(w['nthreads'] for w in workers.values())
+            window['size'], window['checked'] = per_thread * max(1, threads), time.monotonic()
+        new = []
+        for item in itertools.islice(items, max(0, window['size'] - len(futures))):
+            future = submit(item)
+            futures[future] = item
+            new.append(future)
+        return new
+
+    computations = as_completed(top_up(), with_results=True)
+    for future, result in computations:
+        yield futures.pop(future), result
+        future.release()
+        del result
+        computations.update(top_up())
+
+
+def place_groups(groups: list, estimates: list, workers: list, holdings: dict) -> dict:
+    """
+    Give each group home workers in proportion to its share of the estimated cost, at least one each.
+    A group first claims the workers already holding it; every worker has one group unless there are more groups
+    than workers.
+    :param groups: Each trial's group, e.g. its dataset URL.
+    :param holdings: Worker address to the groups it holds.
+    :return: Group to home worker addresses.
+    """
+    cost = defaultdict(float)
+    for g, e in zip(groups, estimates):
+        cost[g] += e
+    ranked = sorted(cost, key=cost.get, reverse=True)
+    if len(workers) == 0:
+        return {}
+    quota = {g: 1 for g in ranked}
+    spare = len(workers) - len(ranked)
+    if spare > 0:  # Largest remainder apportionment of the spare workers.
+        total = sum(cost.values())
+        share = {g: spare * cost[g] / total for g in ranked}
+        for g in ranked:
+            quota[g] += int(share[g])
+        by_remainder = sorted(ranked, key=lambda g: share[g] - int(share[g]), reverse=True)
+        for g in by_remainder[:len(workers) - sum(quota.values())]:
+            quota[g] += 1
+    homes = {g: [] for g in ranked}
+    free = list(workers)
+    for g in ranked:  # Workers that already hold the group.
+        for w in [w for w in free if g in holdings.get(w, ())][:quota[g]]:
+            homes[g].append(w)
+            free.remove(w)
+    for g in ranked:
+        while len(homes[g]) < quota[g] and len(free) > 0:
+            homes[g].append(free.pop(0))
+    for i, g in enumerate(ranked):  # More groups than workers; share them.
+        if len(homes[g]) == 0:
+            homes[g].append(workers[i % len(workers)])
+    return homes
+
+
+def adopt_workers(homes: dict, workers: list, remaining: dict) -> list:
+    """
+    Home each worker that is not yet any group's home with the group that has the most estimated cost left per home
+    worker. Workers are left unhomed once no group has any cost left.
+    :param homes: Group to home worker addresses; extended in place.
+    :param remaining: Group to the estimated seconds of its trials not yet submitted.
+    :return: The adopted worker addresses.
+    """
+    housed = {w for ws in homes.values() for w in ws}
+    adopted = []
+    for w in workers:
+        if w in housed:
+            continue
+        g = max(remaining, key=lambda g: remaining[g] / max(1, len(homes.get(g, []))), default=None)
+        if g is None or remaining[g] <= 0:
+            break
+        homes.setdefault(g, []).append(w)
+        adopted.append(w)
+        logger.info(f'{w} joined; home to {g}.')
+    return adopted
+
+
+def home_workers(client: Client, groups: list, estimates: list, held: callable = None) -> dict:
+    """
+    :param held: Run on each worker, with `Client.run()`; returns the groups it already holds.
+    :return: Group to home worker addresses, per `place_groups()`.
+    """
+    holdings = {} if held is None else client.run(held)
+    homes = place_groups(groups, estimates, list(scheduler_workers(client).keys()), holdings)
+    for g, workers in homes.items():
+        logger.info(f'{g}: {len(workers)} workers.')
+    return homes
+
+
+def plan_homes(exp: dict, client: Client, cost_model: CostModel, cost_features: callable, group: callable,
+               held: callable = None) -> dict:
+    """
+    Place every trial's group before the trials, or their datasets, are distributed; see `home_workers()`.
+    """
+    trials = unroll_params(exp)
+    return home_workers(client, [group(params) for params in trials],
+                        [cost_model.estimate(cost_features(params)) for params in trials], held)
+
+
+def do_on_cluster_longest_first(exp: dict, instance: callable, client: Client,
+                                cost_model: CostModel, cost_features: callable,
+                                credentials: service_account.Credentials = None,
+                                group: callable = None, held: callable = None, homes: dict = None,
+                                per_thread: int = 2,
+                                resume: bool = False, key_columns: list = None,
+                                trial_keys: callable = None, memo: MemoCache = None,
+                                save_every: int = 50) -> CostModel:
+    """
+    Run every trial of `exp`, most expensive first, writing each result as it arrives.
+    Trials are ordered up front, so their params, but not their futures or results, are all held at once.
+    :param cost_features: Maps a trial's params to the `cost_model` features.
+    :param group: Maps a trial's params to its group, e.g. its dataset URL; None for no placement.
+    :param held: Run on each worker; returns the groups it already holds, e.g. the datasets scattered to it.
+    :param homes: Group to home workers, from `plan_homes()`; by default placed here, from the trials to run.
+    Extended in place with the workers that join during the sweep; see `adopt_workers()`.
+    :param per_thread: Tasks in flight per worker thread.
+    :param resume: Skip the trials already in the table; see `resume_filter()` for `key_columns` and `trial_keys`.
+    :param memo: Write the cached results without dispatching their trials, and cache the new ones.
+    :param save_every: Save the cost model every this many completions, as well as at the end.
+    :return: The cost model, refit from the measured trials.
+    """
+    with get_sink(f'EMS.{exp["table_name"]}', credentials) as db:
+        trials = unroll_params(exp)
+        if resume:
+            pending = resume_filter(exp, db, key_columns, trial_keys)
+            total = len(trials)
+            trials = [params for params in trials if pending(params)]
+            logger.info(f'Resume: {total - len(trials)} of {total} trials already complete.')
+        if memo is not None:
+            trials = list(memo.split(instance, trials, db.write))
+            logger.info(f'Memo cache: {memo.hits} trials cached.')
+        if len(trials) == 0:
+            return cost_model
+        features = [cost_features(params) for params in trials]
+        estimates = [cost_model.estimate(f) for f in features]
+        order = sorted(range(len(trials)), key=lambda i: estimates[i], reverse=True)
+        logger.info(f'{len(trials)} trials; estimated {sum(estimates):.0f} seconds, '
+                    f'longest {estimates[order[0]]:.1f}.')
+
+        remaining = defaultdict(float)  # Group to the estimated seconds of its trials not yet submitted.
+        if group is not None:
+            groups = [group(params) for params in trials]
+            if homes is None:
+                homes = home_workers(client, groups, estimates, held)
+            for g, e in zip(groups, estimates):
+                remaining[g] += e
+
+        def on_workers(workers: dict):  # Home the workers that joined since the last look.
+            adopt_workers(homes, list(workers), remaining)
+
+        def submit(ranked: tuple):
+            rank, i = ranked  # Dask runs higher priorities first.
+            restrictions = {}
+            if group is not None:
+                remaining[groups[i]] -= estimates[i]
+                if len(homes.get(groups[i], [])) > 0:  # Loose; other workers may run it when none of its homes exist.
+                    restrictions = {'workers': list(homes[groups[i]]), 'allow_other_workers': True}
+            return client.submit(timed_instance, instance, trials[i], priority=len(order) - rank, pure=False,
+                                 **restrictions)
+
+        completions = run_windowed(client, submit, enumerate(order), per_thread,
+                                   on_workers=None if group is None else on_workers)
+        for done, ((_, i), (df, seconds)) in enumerate(completions, start=1):
+            db.write(df)
+            if memo is not None:
+                memo.put(instance, trials[i], df)
+            cost_model.update(features[i], seconds)
+            logger.info(f'Completed {done}/{len(trials)}: {seconds:.2f} seconds, estimated {estimates[i]:.2f}.')
+            if done % save_every == 0:  # A sweep killed at walltime keeps what it learned.
+                cost_model.save()
+    cost_model.save()
+    return cost_model
+
+
+def do_on_cluster_windowed(exp: dict, instance: callable, client: Client,
+                           credentials: service_account.Credentials = None, per_thread: int = 2,
+                           resume: bool = False, key_columns: list = None, trial_keys: callable = None,
+                           memo: MemoCache = None):
+    """
+    Run every trial of `exp` in grid order, generating the trials lazily, writing each result as it arrives.
+    :param resume: Skip the trials already in the table; see `resume_filter()` for `key_columns` and `trial_keys`.
+    :param memo: Write the cached results without dispatching their trials, and cache the new ones.
+    """
+    def submit(params: dict):
+        return client.submit(timed_instance, instance, params, pure=False)
+
+    with get_sink(f'EMS.{exp["table_name"]}', credentials) as db:
+        trials = iter_params(exp)
+        if resume:
+            trials = filter(resume_filter(exp, db, key_columns, trial_keys), trials)
+        if memo is not None:
+            trials = memo.split(instance, trials, db.write)
+        completions = run_windowed(client, submit, trials, per_thread)
+        for done, (params, (df, seconds)) in enumerate(completions, start=1):
+            db.write(df)
+            if memo is not None:
+                memo.put(instance, params, df)
+            if done % 1000 == 0:
+                logger.info(f'Completed {done}: {seconds:.2f} seconds.')
+    if memo is not None:
+        logger.info(f'Memo cache: {memo.hits} trials cached, {memo.misses} computed.')
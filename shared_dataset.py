@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+import os
+import atexit
+import hashlib
+import tempfile
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+import pyarrow as pa
+import pyarrow.feather as feather
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+"""
+Read-only datasets shared by every trial on a node.
+A dataset is written once per node as uncompressed Feather to a directory of the job, `job-$SLURM_JOB_ID`, under
+`$SHARED_DATASET_DIR`, by default `/dev/shm/stats285`, and memory-mapped by each worker. Numeric columns are
+zero-copy views of the mapping, so every worker process on the node shares one copy in the page cache. All NumPy
+backed columns are read-only; writing into their buffers raises `ValueError: assignment destination is read-only`
+instead of corrupting the data other trials see. The getters hand each trial a shallow copy, so pandas writes, which
+copy on write, and added, replaced or dropped columns stay private to the trial.
+Shared memory outlives the job, so the files are removed when the worker process that wrote them exits, and a
+refreshed dataset replaces its previous version. Workers that still map a removed file keep their mapping; later
+readers write it again.
+"""
+SHARED_DATASET_DIR = 'SHARED_DATASET_DIR'
+WRITTEN = set()  # The files this process wrote.
+
+
+def shared_dir() -> Path:
+    default = '/dev/shm/stats285' if os.path.isdir('/dev/shm') else os.path.join(tempfile.gettempdir(), 'stats285')
+    job = os.environ.get('SLURM_JOB_ID', 'local')
+    return Path(os.environ.get(SHARED_DATASET_DIR, default)).expanduser() / f'job-{job}'
+
+
+@atexit.register
+def remove_written():
+    for path in WRITTEN:
+        path.unlink(missing_ok=True)
+    for path in {p.parent for p in WRITTEN}:
+        try:
+            path.rmdir()  # Only once empty; other workers of the job may still be sharing.
+        except OSError:
+            pass
+    WRITTEN.clear()
+
+
+def read_only_view(df: DataFrame) -> DataFrame:
+    """
+    Rebuild `df` over read-only NumPy arrays. Arrays already read-only, e.g. memory-mapped, are not copied.
+    Extension arrays (Arrow strings, categoricals) are replaced, never written through, and are kept as is.
+    """
+    cols = {}
+    for c in df.columns:
+        s = df[c]
+        if isinstance(s.dtype, np.dtype):
+            a = s.to_numpy()
+            if a.flags.writeable:
+                a = a.copy()
+                a.setflags(write=False)
+            cols[c] = a
+        else:
+            cols[c] = s.array
+    return DataFrame(cols, index=df.index, copy=False)
+
+
+def content_token(key: str, df: DataFrame) -> str:
+    """
+    :return: A hash of the key and the content; it changes whenever the dataset does, e.g. a refreshed table.
+    """
+    content = pd.util.hash_pandas_object(df, index=True).to_numpy().tobytes()
+    return hashlib.sha256(key.encode() + content).hexdigest()[:16]
+
+
+def share_dataset(key: str, df: DataFrame, token: str = None) -> DataFrame:
+    """
+    Place `df` in node shared memory, once per node and content, and return a read-only, memory-mapped view.
+    The file name includes a content hash, so a changed dataset under the same key is never served stale.
+    :param token: The `content_token()` of `df`, when already known.
+    """
+    prefix = hashlib.sha256(key.encode()).hexdigest()[:16]
+    digest = content_token(key, df) if token is None else token
+    path = shared_dir() / f'{prefix}-{digest}.feather'
+    if not path.exists():
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(f'.{os.getpid()}.tmp')
+        try:
+            feather.write_feather(df, tmp, compression='uncompressed')  # Compressed Feather cannot be memory-mapped.
+        except (pa.ArrowInvalid, pa.ArrowTypeError) as e:  # E.g. mixed type object columns.
+            tmp.unlink(missing_ok=True)
+            logger.warning(f'Cannot share {key} ({e}); keeping a private read-only copy.')
+            return read_only_view(df)
+        os.replace(tmp, path)
+        WRITTEN.add(path)
+        for old in path.parent.glob(f'{prefix}-*.feather'):  # Previous versions of the dataset.
+            if old != path:
+                old.unlink(missing_ok=True)
+        logger.info(f'Shared {key} at {path}.')
+    try:
+        table = feather.read_table(pa.memory_map(str(path)), memory_map=True)
+    except FileNotFoundError:  # Removed since the check, by its writer's exit or a refresh.
+        return share_dataset(key, df, digest)
+    return read_only_view(table.to_pandas(split_blocks=True))
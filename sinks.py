@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+import uuid
+import shutil
+import signal
+import sqlite3
+import weakref
+import argparse
+import threading
+from pathlib import Path
+import pandas as pd
+from pandas import DataFrame
+import pyarrow as pa
+import pyarrow.parquet as pq
+from google.oauth2 import service_account
+from uploader import BackgroundUploader
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+"""
+Result sinks. Every driver persists its results through a `Sink` chosen by a spec string:
+    gbq                       BigQuery, the default.
+    parquet:<directory>       A Parquet dataset, one directory per table, one file per batch.
+    duckdb:<file>             A DuckDB database file.
+    sqlite:<file>             A SQLite database file.
+    null                      Discard everything; a network-free backend for benchmarking.
+The spec is read from the `RESULT_SINK` environment variable unless one is passed explicitly.
+Local sinks are append-only and can be synced to BigQuery later with `sync_to_gbq()`.
+A sink flushes whenever `batch_rows` rows, or rows older than `linger` seconds, are buffered, and flushes every open
+sink when the process receives SIGTERM, e.g. from SLURM at walltime, so a killed sweep keeps its results and
+`--resume` skips them.
+"""
+RESULT_SINK = 'RESULT_SINK'
+OPEN_SINKS = weakref.WeakSet()  # Flushed on SIGTERM.
+sigterm_installed = False
+previous_sigterm = signal.SIG_DFL  # The handler `on_sigterm()` replaced.
+
+
+def on_sigterm(signum, frame):
+    logger.warning(f'SIGTERM: flushing {len(OPEN_SINKS)} open sinks.')
+    for sink in list(OPEN_SINKS):
+        if sink.writing:  # Interrupted in its own write; flushing again would duplicate the batch.
+            continue
+        try:
+            sink.flush()
+        except Exception as e:
+            logger.error(f'SIGTERM: could not flush {sink.table_name}: {e}')
+    if callable(previous_sigterm):
+        previous_sigterm(signum, frame)
+    elif previous_sigterm != signal.SIG_IGN:  # Terminate, as the default action would have.
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        os.kill(os.getpid(), signal.SIGTERM)
+
+
+def install_sigterm_flush():
+    """
+    Install `on_sigterm()` once. Python only sets handlers from the main thread; elsewhere this does nothing.
+    """
+    global sigterm_installed, previous_sigterm
+    if not sigterm_installed and threading.current_thread() is threading.main_thread():
+        previous_sigterm = signal.signal(signal.SIGTERM, on_sigterm)
+        sigterm_installed = True
+
+
+class Sink(object):
+    """
+    Batched, append-only writer. Rows are buffered until `batch_rows` accumulate, or the oldest has waited `linger`
+    seconds, and then written in one call. The linger is checked as rows arrive.
+    With `replace`, the first batch replaces the table instead of appending to it.
+    """
+
+    def __init__(self, table_name: str, batch_rows: int = 1000, replace: bool = False, linger: float = 120.):
+        self.table_name = table_name
+        self.batch_rows = batch_rows
+        self.replace = replace
+        self.linger = linger  # Bounds the results lost to a kill, and BigQuery's load jobs to one per linger.
+        self.buffer = []
+        self.buffered_rows = 0
+        self.buffered_since = None
+        self.rows_written = 0
+        self.writing = False
+        OPEN_SINKS.add(self)
+        install_sigterm_flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def write(self, df: DataFrame):
+        if self.buffered_since is None:
+            self.buffered_since = time.time()
+        self.buffer.append(df)
+        self.buffered_rows += len(df)
+        if self.buffered_rows >= self.batch_rows or time.time() - self.buffered_since >= self.linger:
+            self.flush()
+
+    def flush(self):
+        if len(self.buffer) > 0:
+            df = pd.concat(self.buffer, ignore_index=True)
+            self.writing = True
+            try:
+                self._write(df, replace=self.replace)
+            finally:
+                self.writing = False
+            self.replace = False
+            self.rows_written += len(df)
+            self.buffer, self.buffered_rows, self.buffered_since = [], 0, None
+
+    def close(self):
+        self.flush()
+        OPEN_SINKS.discard(self)
+
+    def read(self) -> DataFrame:
+        raise NotImplementedError
+
+    def read_keys(self, columns: list) -> set:
+        """
+        The distinct `columns` tuples already written, e.g. the parameters of completed trials, to resume a sweep.
+        :return: An empty set when the table does not exist yet. Any other failure, e.g. authentication, raises.
+        """
+        df = self._read_columns(columns)
+        if len(df.columns) == 0:
+            logger.info(f'No keys in {self.table_name}: no table.')
+            return set()
+        return set(df[columns].itertuples(index=False, name=None))
+
+    def _read_columns(self, columns: list) -> DataFrame:
+        """
+        :return: At least the `columns`; an empty DataFrame, without columns, when the table does not exist.
+        """
+        return self.read()
+
+    def _write(self, df: DataFrame, replace: bool):
+        raise NotImplementedError
+
+
+class NullSink(Sink):
+
+    def read(self) -> DataFrame:
+        return DataFrame()
+
+    def _write(self, df: DataFrame, replace: bool):
+        pass
+
+
+class GBQSink(Sink):
+
+    def __init__(self, table_name: str, credentials: service_account.Credentials = None,
+                 batch_rows: int = 1000, replace: bool = False, linger: float = 120.):
+        super().__init__(table_name, batch_rows=batch_rows, replace=replace, linger=linger)
+        self.credentials = credentials
+
+    def read(self) -> DataFrame:
+        from google.cloud import bigquery
+
+        client = bigquery.Client(credentials=self.credentials)
+        return client.query(f"SELECT * FROM `{self.table_name}`").to_dataframe()
+
+    def _read_columns(self, columns: list) -> DataFrame:
+        from google.cloud import bigquery
+
+        from google.api_core.exceptions import NotFound
+
+        client = bigquery.Client(credentials=self.credentials)
+        try:
+            client.get_table(self.table_name)
+        except NotFound:
+            return DataFrame()
+        names = ', '.join(f'`{c}`' for c in columns)
+        return client.query(f"SELECT DISTINCT {names} FROM `{self.table_name}`").to_dataframe()
+
+    def _write(self, df: DataFrame, replace: bool):
+        df.to_gbq(self.table_name,
+                  if_exists='replace' if replace else 'append',
+                  progress_bar=False,
+                  credentials=self.credentials)
+
+
+class ParquetSink(Sink):
+    """
+    A Parquet dataset at `<root>/<table_name>/`; each batch is a new, uniquely named file so concurrent
+    writers on a shared filesystem never collide.
+    """
+
+    def __init__(self, root: str, table_name: str, batch_rows: int = 1000, replace: bool = False,
+                 linger: float = 120.):
+        super().__init__(table_name, batch_rows=batch_rows, replace=replace, linger=linger)
+        self.path = Path(root).expanduser() / table_name
+
+    def read(self) -> DataFrame:
+        if not self.path.exists():
+            return DataFrame()
+        return pq.read_table(self.path, memory_map=True).to_pandas()
+
+    def _read_columns(self, columns: list) -> DataFrame:
+        if not self.path.exists():
+            return DataFrame()
+        return pq.read_table(self.path, columns=columns, memory_map=True).to_pandas()
+
+    def _write(self, df: DataFrame, replace: bool):
+        if replace and self.path.exists():
+            shutil.rmtree(self.path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        pq.write_table(table, self.path / f'part-{uuid.uuid4().hex}.parquet', compression='zstd')
+
+
+class SQLiteSink(Sink):
+
+    def __init__(self, path: str, table_name: str, batch_rows: int = 1000, replace: bool = False,
+                 linger: float = 120.):
+        super().__init__(table_name, batch_rows=batch_rows, replace=replace, linger=linger)
+        self.path = os.path.expanduser(path)
+
+    def read(self) -> DataFrame:
+        with sqlite3.connect(self.path) as con:
+            return pd.read_sql_query(f'SELECT * FROM "{self.table_name}"', con)
+
+    def _read_columns(self, columns: list) -> DataFrame:
+        if not os.path.exists(self.path):
+            return DataFrame()
+        names = ', '.join(f'"{c}"' for c in columns)
+        with sqlite3.connect(self.path) as con:
+            if con.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                           (self.table_name,)).fetchone() is None:
+                return DataFrame()
+            return pd.read_sql_query(f'SELECT DISTINCT {names} FROM "{self.table_name}"', con)
+
+    def _write(self, df: DataFrame, replace: bool):
+        with sqlite3.connect(self.path, timeout=60.) as con:  # Wait out other writers' locks.
+            df.to_sql(self.table_name, con, if_exists='replace' if replace else 'append', index=False)
+
+
+class DuckDBSink(Sink):
+
+    def __init__(self, path: str, table_name: str, batch_rows: int = 1000, replace: bool = False,
+                 linger: float = 120.):
+        super().__init__(table_name, batch_rows=batch_rows, replace=replace, linger=linger)
+        self.path = os.path.expanduser(path)
+
+    def read(self) -> DataFrame:
+        import duckdb
+
+        with duckdb.connect(self.path, read_only=True) as con:
+            return con.execute(f'SELECT * FROM "{self.table_name}"').df()
+
+    def _read_columns(self, columns: list) -> DataFrame:
+        import duckdb
+
+        if not os.path.exists(self.path):
+            return DataFrame()
+        names = ', '.join(f'"{c}"' for c in columns)
+        with duckdb.connect(self.path, read_only=True) as con:
+            try:
+                return con.execute(f'SELECT DISTINCT {names} FROM "{self.table_name}"').df()
+            except duckdb.CatalogException:  # No such table.
+                return DataFrame()
+
+    def _write(self, df: DataFrame, replace: bool):
+        import duckdb  # Optional; only needed for this backend.
+
+        with duckdb.connect(self.path) as con:
+            con.register('batch', df)
+            if replace:
+                con.execute(f'CREATE OR REPLACE TABLE "{self.table_name}" AS SELECT * FROM batch')
+            else:
+                con.execute(f'CREATE TABLE IF NOT EXISTS "{self.table_name}" AS SELECT * FROM batch LIMIT 0')
+                con.execute(f'INSERT INTO "{self.table_name}" SELECT * FROM batch')
+
+
+def get_sink(table_name: str, credentials: service_account.Credentials = None, spec: str = None,
+             batch_rows: int = 1000, replace: bool = False, linger: float = 120.) -> Sink:
+    """
+    Build the sink named by `spec`, or by the `RESULT_SINK` environment variable, defaulting to BigQuery.
+    :param table_name: The destination table; for BigQuery, `dataset.table`.
+    :param linger: Seconds a buffered row may wait for its batch to fill.
+    """
+    if spec is None:
+        spec = os.environ.get(RESULT_SINK, 'gbq')
+    kind, _, location = spec.partition(':')
+    match kind:
+        case 'gbq':
+            return GBQSink(table_name, credentials, batch_rows=batch_rows, replace=replace, linger=linger)
+        case 'parquet':
+            return ParquetSink(location, table_name, batch_rows=batch_rows, replace=replace, linger=linger)
+        case 'sqlite':
+            return SQLiteSink(location, table_name, batch_rows=batch_rows, replace=replace, linger=linger)
+        case 'duckdb':
+            return DuckDBSink(location, table_name, batch_rows=batch_rows, replace=replace, linger=linger)
+        case 'null':
+            return NullSink(table_name, batch_rows=batch_rows, replace=replace, linger=linger)
+        case _:
+            raise Exception(f"Invalid Sink: {spec}!")
+
+
+def sync_to_gbq(spec: str, table_name: str, credentials: service_account.Credentials = None,
+                chunk_rows: int = 10000) -> int:
+    """
+    Append a local sink's table to the BigQuery table of the same name, uploading in the background.
+    """
+    df = get_sink(table_name, spec=spec).read()
+    gbq = GBQSink(table_name, credentials, batch_rows=1)  # The uploader does the batching.
+    with BackgroundUploader(gbq.write, max_rows=chunk_rows) as uploader:
+        for start in range(0, len(df), chunk_rows):
+            uploader.push(df.iloc[start:start + chunk_rows])
+    logger.info(f'Synced {uploader.rows_written} rows from {spec} to {table_name}.')
+    return uploader.rows_written
+
+
+if __name__ == "__main__":
+    from EMS.manager import get_gbq_credentials
+
+    logging.basicConfig(level=logging.INFO)
+    logging.info(f'{" ".join(sys.argv)}')
+    parser = argparse.ArgumentParser(prog='sinks')
+    parser.add_argument('spec', type=str, help='The local sink to sync from, e.g. parquet:/scratch/results')
+    parser.add_argument('table_name', type=str)
+    args = parser.parse_args()
+    sync_to_gbq(args.spec, args.table_name,
+                credentials=get_gbq_credentials('stanford-stats-285-donoho-0dc233389eb9.json'))
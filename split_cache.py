@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+import threading
+import numpy as np
+import scipy.sparse as sp
+from sklearn.model_selection import train_test_split
+import xgboost as xgb
+import lightgbm as lgb
+from thread_budget import thread_budget
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+"""
+Per-worker cache of train/test splits and of the boosters' native training data.
+A split depends only upon (url, encoding, token, split_seed), so every hyperparameter setting on a worker sees the
+same split and results are comparable across trials. `get_split()` stamps each split with that key, and the native
+data is cached under it; keys are never object ids, which Python reuses once an object is collected.
+XGBoost's QuantileDMatrix and LightGBM's Dataset hold the quantized/binned training data; histogram construction is
+the same for every depth/reg_lambda/learning_rate, so it is done once.
+The split arrays are read-only and shared by all threads. The native objects are not safe to train on from two
+threads at once, so each worker thread keeps its own.
+X may be a dense matrix or a SciPy CSR matrix; `categorical` lists the columns holding category codes, which are
+handed to each booster's native categorical support.
+A split with `valid_size > 0` also carves a validation fold, X_valid and y_valid, from the training set for early
+stopping; the test set is the same as without it.
+"""
+SPLITS = {}
+NATIVE = threading.local()
+lock = threading.Lock()
+
+
+def get_split(url: str, features: dict, split_seed: int = 0, test_size: float = 0.2, valid_size: float = 0.,
+              encoding: str = None, token: str = None) -> dict:
+    """
+    :param valid_size: Fraction of the training set held out as the validation fold; 0 for none.
+    :param encoding: The features' encoding and `token` their dataset's content token, as given to `get_features()`.
+    :return: A dict with X_train, X_test, y_train, y_test, and X_valid, y_valid when `valid_size > 0`;
+    the arrays are read-only. Its `key` identifies it to the native data caches.
+    """
+    key = (url, encoding, token, split_seed, test_size, valid_size)
+    split = SPLITS.get(key, None)
+    if split is None:
+        with lock:
+            split = SPLITS.get(key, None)
+            if split is None:
+                split = make_split(features, split_seed, test_size, valid_size)
+                split['key'] = key
+                SPLITS[key] = split
+    return split
+
+
+def make_split(features: dict, split_seed: int = 0, test_size: float = 0.2, valid_size: float = 0.) -> dict:
+    X_train, X_test, y_train, y_test = train_test_split(features['X'], features['y'],
+                                                        test_size=test_size, random_state=split_seed)
+    split = {'X_test': X_test, 'y_test': y_test,
+             'categorical': features.get('categorical', np.array([], dtype=np.int64))}
+    if valid_size > 0:
+        X_train, split['X_valid'], y_train, split['y_valid'] = train_test_split(X_train, y_train,
+                                                                                test_size=valid_size,
+                                                                                random_state=split_seed)
+    split['X_train'], split['y_train'] = X_train, y_train
+    for a in split.values():
+        for b in (a.data, a.indices, a.indptr) if sp.issparse(a) else (a,):
+            b.setflags(write=False)
+    return split
+
+
+def feature_types(split: dict) -> list | None:
+    """
+    :return: XGBoost feature types, 'c' for the categorical columns; None when there are none.
+    """
+    if len(split['categorical']) == 0:
+        return None
+    types = ['q'] * split['X_train'].shape[1]
+    for i in split['categorical']:
+        types[i] = 'c'
+    return types
+
+
+def native_cache() -> dict:
+    if not hasattr(NATIVE, 'cache'):
+        NATIVE.cache = {}
+    return NATIVE.cache
+
+
+def get_xgb_data(split: dict) -> tuple:
+    """
+    :param split: From `get_split()`.
+    :return: (dtrain, dtest, dvalid); dtrain is a QuantileDMatrix holding the quantized training data, dtest a DMatrix
+    and dvalid a QuantileDMatrix sharing dtrain's quantiles, or None without a validation fold.
+    """
+    cache = native_cache()
+    key = ('xgb', *split['key'])
+    data = cache.get(key, None)
+    if data is None:
+        data = cache[key] = make_xgb_data(split)
+    return data
+
+
+def make_xgb_data(split: dict) -> tuple:
+    types = feature_types(split)
+    threads = thread_budget()
+    dtrain = xgb.QuantileDMatrix(split['X_train'], label=split['y_train'], nthread=threads,
+                                 feature_types=types, enable_categorical=types is not None)
+    dtest = xgb.DMatrix(split['X_test'], label=split['y_test'], nthread=threads,
+                        feature_types=types, enable_categorical=types is not None)
+    dvalid = None
+    if 'X_valid' in split:
+        dvalid = xgb.QuantileDMatrix(split['X_valid'], label=split['y_valid'], ref=dtrain, nthread=threads,
+                                     feature_types=types, enable_categorical=types is not None)
+    return dtrain, dtest, dvalid
+
+
+def get_lgb_data(split: dict) -> tuple:
+    """
+    :param split: From `get_split()`.
+    :return: (dtrain, dvalid); constructed LightGBM Datasets, their bins reused by every `lgb.train()` on this thread.
+    dvalid shares dtrain's bins, or is None without a validation fold.
+    """
+    cache = native_cache()
+    key = ('lgb', *split['key'])
+    data = cache.get(key, None)
+    if data is None:
+        data = cache[key] = make_lgb_data(split)
+    return data
+
+
+def make_lgb_data(split: dict) -> tuple:
+    def as_lgb(X):
+        return X if sp.issparse(X) else np.asarray(X)
+
+    categorical = [int(i) for i in split['categorical']] if len(split['categorical']) > 0 else 'auto'
+    dtrain = lgb.Dataset(as_lgb(split['X_train']), label=split['y_train'], categorical_feature=categorical,
+                         params={'num_threads': thread_budget(), 'verbose': -1}, free_raw_data=False).construct()
+    dvalid = None
+    if 'X_valid' in split:
+        dvalid = lgb.Dataset(as_lgb(split['X_valid']), label=split['y_valid'], reference=dtrain,
+                             categorical_feature=categorical, free_raw_data=False).construct()
+    return dtrain, dvalid
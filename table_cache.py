@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from pandas import DataFrame
+import pyarrow as pa
+import pyarrow.feather as feather
+from google.cloud import bigquery
+from google.oauth2 import service_account
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+"""
+Content-addressed, on-disk cache of BigQuery tables.
+A table is saved as an uncompressed Feather (Arrow IPC) file named for the table and a hash of its freshness token,
+the table's last modification time and row count. Uncompressed Feather can be memory-mapped on load.
+Only a cache miss runs the `SELECT *`; the freshness check is a free metadata call.
+The cache lives in `$TABLE_CACHE_DIR`, by default `~/.cache/stats285/tables`.
+"""
+TABLE_CACHE_DIR = 'TABLE_CACHE_DIR'
+
+
+def cache_dir() -> Path:
+    return Path(os.environ.get(TABLE_CACHE_DIR, '~/.cache/stats285/tables')).expanduser()
+
+
+def query_table(table_name: str, credentials: service_account.Credentials = None) -> DataFrame:
+    client = bigquery.Client(credentials=credentials)
+    query = f"SELECT * FROM `{table_name}`"
+    df = client.query(query).to_dataframe(create_bqstorage_client=True)  # Storage Read API when installed.
+    return df
+
+
+def freshness_token(table_name: str, credentials: service_account.Credentials = None) -> str:
+    table = bigquery.Client(credentials=credentials).get_table(table_name)
+    return f'{table.modified.isoformat()}/{table.num_rows}'
+
+
+def cache_path(table_name: str, token: str) -> Path:
+    digest = hashlib.sha256(f'{table_name}\n{token}'.encode()).hexdigest()[:16]
+    return cache_dir() / f'{table_name}-{digest}.feather'
+
+
+def read_cached(path: Path) -> DataFrame:
+    with pa.memory_map(str(path)) as source:
+        return feather.read_table(source, memory_map=True).to_pandas()
+
+
+def write_cached(df: DataFrame, path: Path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(f'.{os.getpid()}.tmp')
+    feather.write_feather(df, tmp, compression='uncompressed')  # Compressed Feather cannot be memory-mapped.
+    os.replace(tmp, path)  # Atomic; concurrent drivers never see a partial file.
+    for stale in path.parent.glob(f'{path.name.rsplit("-", 1)[0]}-*.feather'):
+        if stale != path:
+            stale.unlink(missing_ok=True)
+
+
+def get_table(table_name: str, credentials: service_account.Credentials = None, token: str = None) -> DataFrame:
+    """
+    Return the table, from the local cache when it is fresh, otherwise from BigQuery, refreshing the cache.
+    :param token: Freshness token; by default looked up from the table's metadata. If that lookup fails,
+    e.g. offline, the most recent cached copy is used.
+    """
+    if token is None:
+        try:
+            token = freshness_token(table_name, credentials)
+        except Exception as e:
+            cached = sorted(cache_dir().glob(f'{table_name}-*.feather'), key=lambda p: p.stat().st_mtime)
+            if len(cached) > 0:
+                logger.warning(f'Cannot check freshness of {table_name} ({e}); using {cached[-1]}.')
+                return read_cached(cached[-1])
+            raise
+    path = cache_path(table_name, token)
+    if path.exists():
+        logger.info(f'Cache hit: {table_name} <- {path}')
+        return read_cached(path)
+    logger.info(f'Cache miss: {table_name}')
+    df = query_table(table_name, credentials)
+    write_cached(df, path)
+    return df
+
+
+def fetch_tables(tables: dict, credentials: service_account.Credentials = None, workers: int = 8):
+    """
+    Fetch every table concurrently, through the cache, yielding each as soon as it arrives.
+    :param tables: Key to GBQ table name map, e.g. `TABLE_NAMES`.
+    :return: Yields (key, table_name, df, seconds).
+    """
+    def fetch(table_name: str) -> tuple:
+        start_time = time.time()
+        df = get_table(table_name, credentials)
+        return df, time.time() - start_time
+
+    with ThreadPoolExecutor(max_workers=min(workers, max(1, len(tables)))) as pool:
+        futures = {pool.submit(fetch, table): (key, table) for key, table in tables.items()}
+        for future in as_completed(futures):
+            key, table = futures[future]
+            df, seconds = future.result()
+            yield key, table, df, seconds
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+import os
+from collections import Counter
+from threadpoolctl import threadpool_limits
+from dask.distributed import Client, get_worker
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+"""
+Thread budgets for trials, so the boosters' OpenMP pools and BLAS do not oversubscribe a node.
+A Dask worker runs `nthreads` trials at once; each trial gets its share of the worker's cores. When a worker's
+affinity mask is the whole node, e.g. a LocalCluster, the node's cores are shared by every worker slot on the host.
+When it is restricted, e.g. a Slurm allocation, the cores are the worker's own.
+`$THREAD_BUDGET` overrides the computed budget. Setting a budget also caps every BLAS/OpenMP pool in the process,
+through threadpoolctl; the boosters are handed the budget as `nthread`, `num_threads` or `thread_count`.
+"""
+THREAD_BUDGET = 'THREAD_BUDGET'
+BUDGET = {}
+
+
+def available_cores() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # macOS has no affinity masks.
+        return os.cpu_count() or 1
+
+
+def worker_slots() -> int:
+    try:
+        return get_worker().nthreads
+    except ValueError:  # Not on a worker.
+        return 1
+
+
+def slot_threads(host_slots: int, own_slots: int) -> int:
+    """
+    :param host_slots: Worker threads on this worker's host.
+    :param own_slots: This worker's threads.
+    """
+    cores = available_cores()
+    slots = own_slots if cores < (os.cpu_count() or cores) else host_slots
+    return max(1, cores // slots)
+
+
+def set_thread_budget(threads: int) -> int:
+    env = os.environ.get(THREAD_BUDGET, None)
+    threads = int(env) if env else threads
+    if BUDGET.get('threads', None) != threads:
+        threadpool_limits(limits=threads)  # Process wide; not restored.
+        BUDGET['threads'] = threads
+        logger.info(f'Thread budget: {threads}.')
+    return threads
+
+
+def thread_budget() -> int:
+    """
+    :return: The threads one trial may use; the pushed budget, or else computed from this worker alone.
+    """
+    threads = BUDGET.get('threads', None)
+    if threads is None:
+        slots = worker_slots()
+        threads = set_thread_budget(slot_threads(slots, slots))
+    return threads
+
+
+def apply_host_budget(host_slots: dict, dask_worker=None) -> int:
+    return set_thread_budget(slot_threads(host_slots.get(dask_worker.address, dask_worker.nthreads),
+                                          dask_worker.nthreads))
+
+
+def push_thread_budget(client: Client):
+    """
+    Set every connected worker's budget, counting the worker slots that share each host.
+    Workers that join later compute their own budget from their first trial.
+    :return: Worker address to budget map; a coroutine to await on an asynchronous client.
+    """
+    try:
+        workers = client.scheduler_info(n_workers=-1)['workers']  # Newer schedulers list only 5 by default.
+    except TypeError:
+        workers = client.scheduler_info()['workers']
+    per_host = Counter()
+    for w in workers.values():
+        per_host[w['host']] += w['nthreads']
+    host_slots = {address: per_host[w['host']] for address, w in workers.items()}
+    return client.run(apply_host_budget, host_slots)
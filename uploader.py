@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+import time
+import queue
+import random
+import threading
+import pandas as pd
+from pandas import DataFrame
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class BackgroundUploader(object):
+    """
+    Upload DataFrames from a background thread so that computation continues while writes are in flight.
+    Results are batched until `max_rows` rows or `max_bytes` bytes accumulate, or the queue goes idle.
+    Failed writes are retried with exponential backoff and full jitter.
+    `write` is any callable taking a DataFrame, e.g. a `to_gbq` partial or a local stub sink.
+    """
+    _CLOSE = object()
+
+    def __init__(self, write: callable, max_rows: int = 5000, max_bytes: int = 64 * 2**20, max_queue: int = 8,
+                 linger: float = 5., max_retries: int = 6, base_delay: float = 1., max_delay: float = 60.):
+        self.write = write
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.linger = linger  # Seconds to wait for more results before flushing a partial batch.
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.queue = queue.Queue(maxsize=max_queue)  # Bounded; `push()` blocks when uploads fall behind.
+        self.error = None
+        self.rows_written = 0
+        self.thread = threading.Thread(target=self._run, name='BackgroundUploader', daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def push(self, df: DataFrame):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(df)
+
+    def close(self):
+        """
+        Flush everything pushed so far, stop the thread and re-raise any upload failure.
+        """
+        self.queue.put(self._CLOSE)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def _write_with_retry(self, df: DataFrame):
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.write(df)
+                self.rows_written += len(df)
+                return
+            except Exception as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = random.uniform(0., min(self.max_delay, self.base_delay * 2**attempt))
+                logger.warning(f'Upload failed ({e}); retry {attempt + 1} in {delay:.1f} seconds.')
+                time.sleep(delay)
+
+    def _flush(self, batch: list):
+        if len(batch) > 0 and self.error is None:
+            try:
+                self._write_with_retry(pd.concat(batch, ignore_index=True))
+            except Exception as e:
+                logger.error(f'Upload abandoned after {self.max_retries} retries: {e}')
+                self.error = e
+        batch.clear()
+
+    def _run(self):
+        batch, rows, nbytes = [], 0, 0
+        while True:
+            try:
+                df = self.queue.get(timeout=self.linger)
+            except queue.Empty:  # Idle; don't hold a partial batch hostage.
+                self._flush(batch)
+                rows, nbytes = 0, 0
+                continue
+            if df is self._CLOSE:
+                self._flush(batch)
+                return
+            batch.append(df)
+            rows += len(df)
+            nbytes += int(df.memory_usage(deep=True).sum())
+            if rows >= self.max_rows or nbytes >= self.max_bytes:
+                self._flush(batch)
+                rows, nbytes = 0, 0
@@ -3,9 +3,13 @@
 import logging
 import pandas as pd
 from pandas import DataFrame
-from dask.distributed import LocalCluster, Client, worker_client, as_completed
+from dask.base import tokenize
+from dask.distributed import LocalCluster, Client, as_completed
 from google.oauth2 import service_account
-from EMS.manager import Databases, get_gbq_credentials
+from EMS.manager import get_gbq_credentials
+from sinks import get_sink
+from shared_dataset import share_dataset
+from cluster_dataset import fetch_dataset
 
 from google.cloud import aiplatform
 from google.cloud.aiplatform.vizier import pyvizier as vz
@@ -14,15 +18,26 @@ from google.cloud.aiplatform.vizier import Study
 logger = logging.getLogger(__name__)
 
 
+def call_with_params(instance: callable, params: dict) -> DataFrame:
+    return instance(**params)
+
+
 class EvalOnCluster(object):
 
     def __init__(self, client: Client,
                  table_name: str, credentials: service_account.credentials = None):
-        self.db = Databases(table_name, None, credentials, None)
+        # `RESULT_SINK` selects the destination; without a table the results are discarded.
+        self.db = get_sink(f'EMS.{table_name}', credentials, spec='null' if table_name is None else None)
         self.client = client
         self.credentials = credentials
         self.computations = None  # Iterable returning (future, df).
         self.keys = None
+        self.pending = {}  # Dask key to (future, param key) of the computations in flight.
+
+    def key_from_params(self, params: dict) -> tuple:
+        if self.keys is None:
+            self.keys = sorted(params.keys())
+        return tuple(params[k] for k in self.keys)
 
     def eval_params(self, instance: callable, params: dict) -> tuple:
         """
@@ -31,25 +46,69 @@ class EvalOnCluster(object):
         :param params: The `kwargs` to be passed to the `instance`
         :return: A tuple of param values suitable to become a key in a dict.
         """
+        return self.eval_many(instance, [params])[0]
 
-        if self.keys is None:
-            self.keys = sorted(params.keys())
-        futures = self.client.map(lambda p: instance(**p), [params])  # To isolate kwargs, use a lambda function.
+    def eval_many(self, instance: callable, params_list: list) -> list:
+        """
+        Evaluate the instance with each params in one submission. Dask keys are deterministic, a token of the instance
+        and the params, so a duplicate, in the list or still in flight, is computed once and yields one result.
+        :return: The tuples of param values, as from `eval_params()`, in order.
+        """
+        keys, submit = [], {}
+        for params in params_list:
+            keys.append(self.key_from_params(params))
+            dask_key = f'{instance.__name__}-{tokenize(instance, sorted(params.items()))}'
+            if dask_key not in self.pending and dask_key not in submit:
+                submit[dask_key] = (params, keys[-1])
+        if len(submit) == 0:
+            return keys
+        futures = self.client.map(call_with_params, [instance] * len(submit), [p for p, _ in submit.values()],
+                                  key=list(submit.keys()))
+        for future, (dask_key, (_, key)) in zip(futures, submit.items()):
+            self.pending[dask_key] = (future, key)
         if self.computations is None:
             self.computations = as_completed(futures, with_results=True)
         else:
             self.computations.update(futures)
-        return tuple(params[k] for k in self.keys)
+        return keys
+
+    def retire(self, batch: list) -> list:
+        """
+        Write a batch of completed computations to the database in one push and release them.
+        :return: (DataFrame, key) for each computation.
+        """
+        results = []
+        for future, result in batch:
+            _, key = self.pending.pop(future.key)
+            future.release()  # EP function; release the data; will not be reused.
+            results.append((result, key))
+        self.db.write(pd.concat([df for df, _ in results], ignore_index=True))
+        return results
 
     def result(self) -> (DataFrame, tuple):  # Return a DataFrame and a key.
-        future, result = next(self.computations)
-        self.db.push(result)
-        future.release()  # EP function; release the data; will not be reused.
-        values = result[self.keys].to_numpy()
-        yield result, tuple(v for v in values[0])
+        """
+        Yield the next batch of completed computations, waiting for at least one.
+        """
+        if self.computations is not None and not self.computations.is_empty():
+            yield from self.retire(self.computations.next_batch(block=True))
+
+    def __iter__(self):
+        """
+        Yield (DataFrame, key) until no computation is in flight, including those submitted while iterating.
+        Completed computations are drained from `as_completed` in batches.
+        """
+        while self.computations is not None and not self.computations.is_empty():
+            yield from self.retire(self.computations.next_batch(block=True))
+
+    async def __aiter__(self):
+        while self.computations is not None and not self.computations.is_empty():
+            batch = [await self.computations.__anext__()]
+            batch.extend(self.computations.next_batch(block=False))
+            for df, key in self.retire(batch):
+                yield df, key
 
     def final_push(self):
-        self.db.final_push()
+        self.db.close()
         self.client.shutdown()
 
 
@@ -63,16 +122,23 @@ def on_worker() -> bool:
         return False
 
 
-def get_dataset(key: str) -> DataFrame:
-    if on_worker():
-        with worker_client() as wc:
-            df = wc.get_dataset(name=key, default=None)
-    else:
-        wc = Client.current(allow_global=True)
-        df = wc.get_dataset(name=key, default=None)
-    if df is not None:
-        return df.copy(deep=True)  # Defend against mutating common data.
-    return None
+DATASETS = {}
+
+
+def get_dataset(key: str, read_only: bool = True) -> DataFrame:
+    """
+    Fetch a distributed dataset once per worker into node shared, memory-mapped, read-only buffers.
+    :param read_only: Return a shallow copy of the shared frame: its buffers are the zero-copy, read-only views, while
+    adding, replacing or dropping its columns stays private to the caller. Otherwise a private deep copy.
+    """
+    df = DATASETS.get(key, None)
+    if df is None:
+        df = fetch_dataset(key)  # From this worker's own data when scattered; no `worker_client()`.
+        if df is None:
+            return None
+        df = share_dataset(key, df)
+        DATASETS[key] = df
+    return df.copy(deep=not read_only)  # Never the cached frame itself; a trial may restructure its own.
 
 
 # Objective function to maximize.
@@ -124,18 +190,20 @@ def setup_vertex_on_local_cluster_1(credentials: service_account.Credentials):
             # ec = EvalOnCluster(client, 'test_cluster_01')
             in_cluster = {}
             for _ in range(20):
-                for suggestion in study.suggest(count=100):
+                suggestions = study.suggest(count=100)
+                params_list = []
+                for suggestion in suggestions:
                     params = suggestion.materialize().parameters.as_dict()
                     params['x'] = round(params['x'])
-                    key = ec.eval_params(experiment_1, params)
-                    in_cluster[key] = suggestion
-                for df, key in ec.result():
+                    params_list.append(params)
+                for key, suggestion in zip(ec.eval_many(experiment_1, params_list), suggestions):
+                    in_cluster.setdefault(key, []).append(suggestion)  # Duplicates share one computation.
+                for df, key in ec:  # Drains every pending computation, in batches.
                     measurement = vz.Measurement()
                     measurement.metrics['metric_name'] = df.iloc[0]['objective']
-                    suggestion = in_cluster[key]
-                    suggestion.add_measurement(measurement=measurement)
-                    suggestion.complete(measurement=measurement)
-                    del in_cluster[key]
+                    for suggestion in in_cluster.pop(key):
+                        suggestion.add_measurement(measurement=measurement)
+                        suggestion.complete(measurement=measurement)
             ec.final_push()
     optimal_trials = study.optimal_trials()
     logger.info(f'{optimal_trials}')
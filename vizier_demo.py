@@ -10,7 +10,8 @@ import dask
 from dask.distributed import LocalCluster, Client, as_completed, Future
 from google.oauth2 import service_account
 import sqlalchemy as sa
-from EMS.manager import Databases, get_gbq_credentials
+from EMS.manager import get_gbq_credentials
+from sinks import get_sink
 
 from vizier.service import clients
 from vizier.service import pyvizier as vz
@@ -22,7 +23,8 @@ class EvalOnCluster(object):
 
     def __init__(self, client: Client,
                  table_name: str, credentials: service_account.credentials = None):
-        self.db = Databases(table_name, None, credentials, None)
+        # `RESULT_SINK` selects the destination; without a table the results are discarded.
+        self.db = get_sink(f'EMS.{table_name}', credentials, spec='null' if table_name is None else None)
         self.client = client
         self.credentials = credentials
         self.experiment = None  # Iterable returning (future, df).
@@ -47,13 +49,13 @@ class EvalOnCluster(object):
 
     def result(self) -> (DataFrame, tuple):  # Return a DataFrame and a key.
         future, result = next(self.experiment)
-        self.db.push(result)
+        self.db.write(result)
         future.release()  # EP function; release the data; will not be reused.
         values = result[self.keys].to_numpy()
         yield result, tuple(v for v in values[0])
 
     def final_push(self):
-        self.db.final_push()
+        self.db.close()
         self.client.shutdown()
 
 
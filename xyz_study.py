@@ -0,0 +1,541 @@
+#!/usr/bin/env python3
+
+import time
+import sys
+import resource
+from pathlib import Path
+import numpy as np
+import scipy.sparse as sp
+from sklearn.metrics import accuracy_score, log_loss, roc_auc_score, mean_squared_error, r2_score
+from sklearn.preprocessing import LabelEncoder
+import xgboost as xgb
+import catboost
+import lightgbm as lgb
+import pandas as pd
+from pandas import DataFrame
+
+from dask.distributed import Client
+from google.oauth2 import service_account
+from table_cache import get_table, query_table, fetch_tables
+from shared_dataset import share_dataset, content_token
+from cluster_dataset import DatasetDistribution, distribute_dataset, fetch_dataset, scattered_here
+from feature_cache import get_features
+from memo_cache import memo_cache, canonical_params
+from thread_budget import thread_budget, push_thread_budget
+from scheduler import CostModel, cost_model_path, await_workers, plan_homes, do_on_cluster_longest_first
+from split_cache import get_split, make_split, get_xgb_data, make_xgb_data, get_lgb_data, make_lgb_data
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+"""
+The XYZ study shared by the `xyz_ems.py` and `xyz_vertex.py` drivers: the datasets and their encodings, the boosted
+trial, `experiment()`, its metrics and cost model, and the distribution of the datasets to the cluster.
+The drivers differ only in how they choose the trials, a grid with EMS or suggestions from Vizier.
+Let’s do these four datasets:
+1) Adult Income: https://archive.ics.uci.edu/dataset/2/adult
+2) California housing: https://www.kaggle.com/datasets/camnugent/california-housing-prices
+3) Forest Covertype: https://archive.ics.uci.edu/dataset/31/covertype
+4) Higgs: https://www.kaggle.com/c/higgs-boson
+"""
+
+
+class StudyBOOST:
+    XGBOOST = 'xgboost'
+    CATBOOST = 'catboost'
+    LIGHTGBM = 'lightgbm'
+
+
+class StudyURL:
+    UCIML_ADULT_INCOME = 'https://archive.ics.uci.edu/dataset/2/adult'
+    KAGGLE_CALIFORNIA_HOUSING_PRICES = 'https://www.kaggle.com/datasets/camnugent/california-housing-prices'
+    UCIML_FOREST_COVERTYPE = 'https://archive.ics.uci.edu/dataset/31/covertype'
+    KAGGLE_HIGGS_BOSON = 'https://www.kaggle.com/c/higgs-boson/'
+    KAGGLE_HIGGS_BOSON_TRAINING = 'https://www.kaggle.com/c/higgs-boson/training'
+    KAGGLE_HIGGS_BOSON_TEST = 'https://www.kaggle.com/c/higgs-boson/test'
+
+
+class StudyENCODING:
+    ONE_HOT = 'one_hot'  # Dense one-hot indicator columns.
+    SPARSE = 'sparse'  # One-hot indicators in a SciPy CSR matrix.
+    CATEGORICAL = 'categorical'  # Category codes, split natively by each booster.
+
+
+DATASET_ENCODINGS = {  # URL to categorical encoding map; unlisted datasets are one-hot encoded.
+    StudyURL.UCIML_ADULT_INCOME: StudyENCODING.CATEGORICAL,
+}
+
+
+DATASET_OBJECTIVES = {  # URL to objective type map; unlisted datasets are inferred from the target's dtype.
+    StudyURL.UCIML_ADULT_INCOME: 'bin',
+    StudyURL.KAGGLE_CALIFORNIA_HOUSING_PRICES: 'reg',
+    StudyURL.UCIML_FOREST_COVERTYPE: 'mult',  # Cover_Type is an integer class label, 1 to 7.
+    StudyURL.KAGGLE_HIGGS_BOSON_TRAINING: 'bin',
+    StudyURL.KAGGLE_HIGGS_BOSON_TEST: 'bin',
+}
+
+
+TABLE_NAMES = {  # URL to GBQ table name map.
+    StudyURL.UCIML_ADULT_INCOME: 'XYZ.adult_income',
+    StudyURL.KAGGLE_CALIFORNIA_HOUSING_PRICES: 'XYZ.california_housing_prices',
+    StudyURL.UCIML_FOREST_COVERTYPE: 'XYZ.forest_covertype',
+    StudyURL.KAGGLE_HIGGS_BOSON_TRAINING: 'XYZ.higgs_boson_training',
+    StudyURL.KAGGLE_HIGGS_BOSON_TEST: 'XYZ.higgs_boson_test',
+}
+
+
+def get_df_from_gbq(table_name, credentials: service_account.Credentials = None, cache: bool = True):
+    if cache:  # Serve from the local on-disk cache; query GBQ only on a miss.
+        return get_table(table_name, credentials)
+    return query_table(table_name, credentials)
+
+
+def push_tables_to_cluster(tables: dict, c: Client, credentials: service_account.Credentials = None,
+                           concurrent: bool = True, mode: str = DatasetDistribution.SCATTER,
+                           workers: callable = None) -> dict:
+    """
+    Fetch the tables, concurrently by default, and distribute each one to the cluster as soon as it arrives.
+    :param mode: A `DatasetDistribution`; SCATTER broadcasts Arrow tables to every worker, PUBLISH pickles the
+    frames through the scheduler.
+    :param workers: Maps the statistics of every table, once all are fetched, to each table's worker addresses,
+    e.g. its home workers; the tables are then scattered to those workers only, and the others published.
+    :return: Per table statistics: rows, bytes, content token, fetch and publish seconds; a coroutine returning
+    them on an asynchronous client.
+    """
+    if c.asynchronous:
+        return push_tables_to_cluster_async(tables, c, credentials, concurrent, mode)
+    def distribute(key: str, df: DataFrame, mode: str, addresses: list = None):
+        start_time = time.time()
+        distribute_dataset(c, key, df, mode, addresses)
+        stats[key]['publish_seconds'] = time.time() - start_time
+        logger.info(f'{key}: {stats[key]}')
+
+    stats, frames = {}, {}
+    for key, table, df, fetch_seconds in fetch_tables(tables, credentials, workers=8 if concurrent else 1):
+        stats[key] = {'table': table, 'rows': len(df), 'bytes': int(df.memory_usage(deep=True).sum()),
+                      'token': content_token(key, df), 'fetch_seconds': fetch_seconds}
+        if workers is None:  # As soon as it arrives.
+            distribute(key, df, mode)
+        else:
+            frames[key] = df
+    if workers is not None:
+        addresses = workers(stats)
+        for key, df in frames.items():  # A table no trial uses is only published, for on demand use.
+            if key in addresses:
+                distribute(key, df, mode, addresses[key])
+            else:
+                distribute(key, df, DatasetDistribution.PUBLISH)
+    return stats
+
+
+async def push_tables_to_cluster_async(tables: dict, c: Client, credentials: service_account.Credentials = None,
+                                       concurrent: bool = True, mode: str = DatasetDistribution.SCATTER) -> dict:
+    stats = {}
+    # The fetches block the event loop; nothing else runs yet.
+    for key, table, df, fetch_seconds in fetch_tables(tables, credentials, workers=8 if concurrent else 1):
+        start_time = time.time()
+        await distribute_dataset(c, key, df, mode)
+        stats[key] = {'table': table, 'rows': len(df), 'bytes': int(df.memory_usage(deep=True).sum()),
+                      'token': content_token(key, df),
+                      'fetch_seconds': fetch_seconds, 'publish_seconds': time.time() - start_time}
+        logger.info(f'{key}: {stats[key]}')
+    return stats
+
+
+def push_tables_to_filesystem(tables: dict, path: Path, credentials: service_account.Credentials = None):
+    for key, table in tables.items():
+        df = get_df_from_gbq(table, credentials)
+        filename = table + '.parquet'
+        p = path / filename
+        df.to_parquet(path=p)
+        logger.info(f'{key}\n{df}')
+
+
+DATASETS = {}
+DATASET_TOKENS = {}  # Key to `content_token()`.
+
+
+def get_local_dataset(key: str, read_only: bool = True) -> DataFrame:
+    """
+    Load the dataset once per worker into node shared, memory-mapped, read-only buffers.
+    :param read_only: Return a shallow copy of the shared frame: its buffers are the zero-copy, read-only views, while
+    adding, replacing or dropping its columns stays private to the caller. Otherwise a private deep copy.
+    """
+    df = DATASETS.get(key, None)
+    if df is None:
+        df = fetch_dataset(key)
+        DATASET_TOKENS[key] = content_token(key, df)
+        df = share_dataset(key, df, DATASET_TOKENS[key])
+        DATASETS[key] = df
+    return df.copy(deep=not read_only)  # Never the cached frame itself; a trial may restructure its own.
+
+
+def memo_salt(stats: dict) -> str:
+    """
+    :param stats: From `push_tables_to_cluster()`.
+    :return: The memo cache salt: the inputs of `experiment()` its fingerprint cannot see, the dataset encodings,
+    objectives and contents.
+    """
+    return canonical_params({'encodings': DATASET_ENCODINGS, 'objectives': DATASET_OBJECTIVES,
+                             'tokens': {k: s['token'] for k, s in stats.items()}})
+
+
+def dataset_token(key: str) -> str:
+    get_local_dataset(key)
+    return DATASET_TOKENS[key]
+
+
+def held_datasets(dask_worker=None) -> list:
+    """
+    Run on a worker, with `Client.run()`, to learn which datasets the worker already holds: loaded or scattered to it.
+    """
+    return sorted(set(DATASETS.keys()) | set(scattered_here(dask_worker)))
+
+
+def encode_xy(X_df: DataFrame, y_df: DataFrame, obj_type: str = None) -> dict:
+    """
+    Encode the normalized frames into the features dict cached by `feature_cache.get_features()`.
+    :param obj_type: 'reg', 'bin' or 'mult', from `dataset_objective()`; by default a numeric target is regressed and
+    any other is classified. A classification is 'bin' or 'mult' by its number of labels.
+    """
+    # Create data array
+    X, categorical = encode_x(X_df)
+
+    # Convert y into target array
+    y_array = y_df.iloc[:, 0].to_numpy()
+
+    # Create target vector
+    if obj_type is None:
+        obj_type = 'reg' if np.issubdtype(y_array.dtype, np.number) else 'bin'
+    if obj_type == 'reg':
+        y = y_array
+        num_classes = 1
+        classes = np.array([])
+    else:
+        # If y is categorical (including strings and integer class labels), use LabelEncoder for encoding
+        encoder = LabelEncoder()
+        y = encoder.fit_transform(y_array)
+        num_classes = len(encoder.classes_)
+        obj_type = 'bin' if num_classes == 2 else 'mult'
+        classes = encoder.classes_.astype(str)
+    return {'X': X, 'y': y, 'num_classes': num_classes, 'obj_type': obj_type,
+            'classes': classes, 'columns': X_df.columns.to_numpy().astype(str), 'categorical': categorical}
+
+
+def encode_x(X_df: DataFrame) -> (np.ndarray | sp.csr_matrix, np.ndarray):
+    """
+    Sparse columns give a float32 CSR matrix; otherwise a dense float32 matrix, with category columns as their codes.
+    :return: (X, the indices of the category columns).
+    """
+    categorical = np.array([i for i, dtype in enumerate(X_df.dtypes) if isinstance(dtype, pd.CategoricalDtype)],
+                           dtype=np.int64)
+    if any(isinstance(dtype, pd.SparseDtype) for dtype in X_df.dtypes):
+        return sp.csr_matrix(X_df.astype(pd.SparseDtype(np.float32, 0.)).sparse.to_coo()), categorical
+    codes = {c: X_df[c].cat.codes.replace(-1, np.nan) for c in X_df.columns[categorical]}  # -1 is missing.
+    X = X_df.assign(**codes).to_numpy(dtype=np.float32, na_value=np.nan)
+    return X, categorical
+
+
+def catboost_pool(X: np.ndarray | sp.csr_matrix, y: np.ndarray, categorical: np.ndarray) -> catboost.Pool:
+    if sp.issparse(X):  # CatBoost will not read a read-only sparse buffer.
+        return catboost.Pool(X.copy(), label=y)
+    if len(categorical) == 0:
+        return catboost.Pool(X, label=y)
+    df = DataFrame(X)
+    for i in categorical:  # CatBoost requires integer or string categories.
+        df[i] = df[i].fillna(-1).astype(np.int64)
+    return catboost.Pool(df, label=y, cat_features=[int(i) for i in categorical])
+
+
+def encode_dataset(url: str, encoding: str = None) -> dict:
+    df, y_df = normalize_dataset(url, get_local_dataset(url), encoding)
+    return encode_xy(df, y_df, dataset_objective(url))
+
+
+# Objective functions to maximize.
+def experiment_local(*, url: str, X_df: DataFrame, y_df: DataFrame, boost: str,
+                     depth: int, reg_lambda: float, learning_rate: float, num_rounds: int | tuple,
+                     early_stopping_rounds: int = None) -> DataFrame:
+    return experiment_features(url=url, features=encode_xy(X_df, y_df, dataset_objective(url)), boost=boost,
+                               depth=depth, reg_lambda=reg_lambda, learning_rate=learning_rate, num_rounds=num_rounds,
+                               early_stopping_rounds=early_stopping_rounds, cache=False)
+
+
+def experiment_features(*, url: str, features: dict, boost: str,
+                        depth: int, reg_lambda: float, learning_rate: float, num_rounds: int | tuple,
+                        early_stopping_rounds: int = None, valid_size: float = 0.2,
+                        split_seed: int = 0, cache: bool = True, encoding: str = None, token: str = None) -> DataFrame:
+    """
+    Train and score one hyperparameter setting.
+    :param num_rounds: A round count, or a sequence of them. One model is trained to the largest count and scored at
+    every count, from its first trees; one row per round count.
+    :param early_stopping_rounds: Stop once the loss on a validation fold, `valid_size` of the training set, has not
+    improved for this many rounds. Round counts past the best round are scored at the best round, `best_rounds`.
+    :param split_seed: Seeds the train/test split, so trials with the same seed are comparable.
+    :param cache: Reuse the worker's split and native booster data for `url`; set False for ad hoc frames.
+    :param encoding: The encoding and `token` the content token the cached `features` were built from.
+    :return: The settings, `metrics()`, train_seconds, for the shared fit, predict_seconds, for the round count,
+    and peak_rss_mb, the worker process' peak resident memory so far.
+    """
+    logger.warning(f'url: {url}; boost: {boost}\n{depth}, {reg_lambda}, {learning_rate}, {num_rounds}')
+    num_classes, obj_type = features['num_classes'], features['obj_type']
+    rounds = sorted({int(r) for r in np.atleast_1d(num_rounds)})
+    max_rounds = rounds[-1]
+    valid_size = 0. if early_stopping_rounds is None else valid_size
+    threads = thread_budget()  # This worker slot's share of the cores.
+
+    # Split into train and test
+    split = get_split(url, features, split_seed, valid_size=valid_size, encoding=encoding, token=token) if cache \
+        else make_split(features, split_seed, valid_size=valid_size)
+
+    match boost:
+        case StudyBOOST.XGBOOST:
+            xgb_params = {'learning_rate': learning_rate, 'reg_lambda': reg_lambda, 'max_depth': depth,
+                          'nthread': threads}
+            match obj_type:
+                case 'reg':
+                    xgb_params['objective'] = 'reg:squarederror'
+                case 'bin':
+                    xgb_params['objective'] = 'binary:logistic'
+                case 'mult':
+                    xgb_params['objective'] = 'multi:softprob'
+                    xgb_params['num_class'] = num_classes
+            dtrain, dtest, dvalid = get_xgb_data(split) if cache else make_xgb_data(split)
+            start_time = time.time()
+            if dvalid is None:
+                model = xgb.train(xgb_params, dtrain, num_boost_round=max_rounds)
+                best_rounds = max_rounds
+            else:
+                model = xgb.train(xgb_params, dtrain, num_boost_round=max_rounds, evals=[(dvalid, 'valid')],
+                                  early_stopping_rounds=early_stopping_rounds, verbose_eval=False)
+                best_rounds = model.best_iteration + 1
+            train_seconds = time.time() - start_time
+
+            def predict(r: int) -> np.ndarray:
+                return model.predict(dtest, iteration_range=(0, r))
+        case StudyBOOST.CATBOOST:
+            cb_params = {'learning_rate': learning_rate, 'l2_leaf_reg': reg_lambda, 'depth': depth,
+                         'iterations': max_rounds, 'thread_count': threads, 'silent': True,
+                         'allow_writing_files': False}  # No catboost_info/ in the shared working directory.
+            model = catboost.CatBoostRegressor(**cb_params) if obj_type == 'reg' \
+                else catboost.CatBoostClassifier(**cb_params)
+            train_pool = catboost_pool(split['X_train'], split['y_train'], split['categorical'])
+            test_pool = catboost_pool(split['X_test'], split['y_test'], split['categorical'])
+            start_time = time.time()
+            if 'X_valid' in split:  # Keeps only the trees up to the best round.
+                model.fit(train_pool, eval_set=catboost_pool(split['X_valid'], split['y_valid'], split['categorical']),
+                          early_stopping_rounds=early_stopping_rounds)
+            else:
+                model.fit(train_pool)
+            best_rounds = model.tree_count_
+            train_seconds = time.time() - start_time
+
+            def predict(r: int) -> np.ndarray:
+                match obj_type:
+                    case 'reg':
+                        return model.predict(test_pool, ntree_end=r)
+                    case 'bin':
+                        return model.predict_proba(test_pool, ntree_end=r)[:, 1]
+                    case _:
+                        return model.predict_proba(test_pool, ntree_end=r)
+        case StudyBOOST.LIGHTGBM:
+            lgb_params = {'learning_rate': learning_rate, 'lambda_l2': reg_lambda, 'max_depth': depth,
+                          'num_threads': threads, 'verbose': -1}
+            match obj_type:
+                case 'reg':
+                    lgb_params['objective'] = 'regression'
+                case 'bin':
+                    lgb_params['objective'] = 'binary'
+                case 'mult':
+                    lgb_params['objective'] = 'multiclass'
+                    lgb_params['num_class'] = num_classes
+            dtrain, dvalid = get_lgb_data(split) if cache else make_lgb_data(split)
+            start_time = time.time()
+            if dvalid is None:
+                model = lgb.train(lgb_params, dtrain, num_boost_round=max_rounds)
+                best_rounds = max_rounds
+            else:
+                model = lgb.train(lgb_params, dtrain, num_boost_round=max_rounds, valid_sets=[dvalid],
+                                  callbacks=[lgb.early_stopping(early_stopping_rounds, verbose=False)])
+                best_rounds = model.best_iteration
+            train_seconds = time.time() - start_time
+
+            def predict(r: int) -> np.ndarray:
+                return model.predict(split['X_test'], num_iteration=r)
+        case _:
+            raise Exception("Invalid Method Name!")
+
+    rows = []
+    for r in rounds:
+        start_time = time.time()
+        test_preds = predict(min(r, best_rounds))
+        predict_seconds = time.time() - start_time
+        rows.append(metrics(test_preds, split['y_test'], obj_type, num_classes) |
+                    {'train_seconds': train_seconds, 'predict_seconds': predict_seconds})
+
+    df = DataFrame(data={'url': url, 'boost': boost, 'depth': depth,
+                         'reg_lambda': reg_lambda, 'learning_rate': learning_rate, 'num_rounds': rounds})
+    df = pd.concat([df, DataFrame(rows)], axis=1)
+    if early_stopping_rounds is not None:
+        df['best_rounds'] = best_rounds
+    df['peak_rss_mb'] = peak_rss_mb()
+    return df
+
+
+METRICS = ['test_accuracy', 'test_log_loss', 'test_auc', 'test_rmse', 'test_r2']
+
+
+def metrics(test_preds: np.ndarray, y_test: np.ndarray, obj_type: str, num_classes: int) -> dict:
+    """
+    Vectorized test metrics for the objective; those that do not apply are NaN, so every row has the same columns.
+    :param test_preds: Predicted values ('reg'), positive class probabilities ('bin') or class probabilities ('mult').
+    """
+    m = dict.fromkeys(METRICS, np.nan)
+    match obj_type:
+        case 'reg':
+            m['test_rmse'] = float(np.sqrt(mean_squared_error(y_test, test_preds)))
+            m['test_r2'] = r2_score(y_test, test_preds)
+        case 'bin':
+            m['test_accuracy'] = accuracy_score(y_test, (test_preds > 0.5).astype(y_test.dtype))
+            m['test_log_loss'] = log_loss(y_test, test_preds, labels=[0, 1])
+            if len(np.unique(y_test)) == 2:  # AUC is undefined for a single class.
+                m['test_auc'] = roc_auc_score(y_test, test_preds)
+        case 'mult':
+            m['test_accuracy'] = accuracy_score(y_test, test_preds.argmax(axis=1))
+            m['test_log_loss'] = log_loss(y_test, test_preds, labels=np.arange(num_classes))
+        case _:
+            raise Exception("Invalid Objective Type!")
+    return m
+
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10  # Bytes on macOS, KiB on Linux.
+
+
+def category_encode(df: DataFrame, encoding: str = StudyENCODING.ONE_HOT) -> DataFrame:
+    # Select object columns
+    object_cols = df.select_dtypes(include='object').columns
+
+    match encoding:
+        case StudyENCODING.ONE_HOT:
+            # One-hot encode these columns
+            df_encoded = pd.get_dummies(df, columns=object_cols)
+        case StudyENCODING.SPARSE:
+            df_encoded = pd.get_dummies(df, columns=object_cols, sparse=True, dtype=np.float32)
+        case StudyENCODING.CATEGORICAL:
+            df_encoded = df.astype({c: 'category' for c in object_cols})
+        case _:
+            raise Exception("Invalid Encoding Name!")
+
+    # Preview
+    logger.info(f'{df_encoded.head()}')
+
+    return df_encoded
+
+
+def dataset_encoding(url: str) -> str:
+    return DATASET_ENCODINGS.get(url, StudyENCODING.ONE_HOT)
+
+
+def dataset_objective(url: str) -> str | None:
+    return DATASET_OBJECTIVES.get(url, None)
+
+
+def normalize_dataset(url: str, df: DataFrame, encoding: str = None) -> (DataFrame, DataFrame):
+    """
+    :param encoding: A `StudyENCODING`; by default the dataset's entry in `DATASET_ENCODINGS`.
+    """
+    match url:
+        case StudyURL.UCIML_ADULT_INCOME:
+            y_df = df[['income']]
+            X_df = df.drop('income', axis=1)
+        case StudyURL.KAGGLE_CALIFORNIA_HOUSING_PRICES:
+            y_df = df[['median_house_value']]
+            X_df = df.drop('median_house_value', axis=1)
+        case StudyURL.UCIML_FOREST_COVERTYPE:
+            y_df = df[['Cover_Type']]
+            X_df = df.drop('Cover_Type', axis=1)
+        case StudyURL.KAGGLE_HIGGS_BOSON_TRAINING | StudyURL.KAGGLE_HIGGS_BOSON_TEST:
+            y_df = df[['Label']]
+            X_df = df.drop('Label', axis=1)
+        case _:
+            raise Exception("Invalid Dataset Name!")
+    X_df = category_encode(X_df, dataset_encoding(url) if encoding is None else encoding)
+    return X_df, y_df
+
+
+def experiment(*, url: str, boost: str, depth: int, reg_lambda: float, learning_rate: float, num_rounds: int | tuple,
+               early_stopping_rounds: int = None) -> DataFrame:
+    encoding, token = dataset_encoding(url), dataset_token(url)
+    features = get_features(url, lambda: encode_dataset(url, encoding),  # Encoded once per worker, not per trial.
+                            encoding=encoding, token=token)
+    return experiment_features(url=url, features=features, boost=boost,
+                               depth=depth, reg_lambda=reg_lambda, learning_rate=learning_rate, num_rounds=num_rounds,
+                               early_stopping_rounds=early_stopping_rounds, encoding=encoding, token=token)
+
+
+COST_PRIOR = {  # log(seconds) coefficients; refit from every completed trial.
+    'bias': -16.5, 'log_rows': 1., 'log_rounds': 1., 'depth': 0.35,
+    StudyBOOST.XGBOOST: 0., StudyBOOST.LIGHTGBM: -0.5, StudyBOOST.CATBOOST: 1.,
+}
+
+
+def cost_features(params: dict, rows: dict) -> dict:
+    """
+    :param rows: URL to dataset row count map, from `push_tables_to_cluster()`.
+    """
+    return {'bias': 1., 'log_rows': np.log(rows.get(params['url'], 100_000)),
+            'log_rounds': np.log(max(np.atleast_1d(params['num_rounds']))), 'depth': params['depth'],
+            params['boost']: 1.}
+
+
+RESULT_KEYS = ['url', 'boost', 'depth', 'reg_lambda', 'learning_rate', 'num_rounds']
+
+
+def result_keys(params: dict) -> list:
+    """
+    :return: The `RESULT_KEYS` of each row a trial writes, one per round count, to resume a sweep.
+    """
+    return [(params['url'], params['boost'], params['depth'], params['reg_lambda'], params['learning_rate'], r)
+            for r in sorted({int(r) for r in np.atleast_1d(params['num_rounds'])})]
+
+
+def setup_experiment(url: str, boost: str, depth: int, reg_lambda: float, learning_rate: float, num_rounds: int,
+                     credentials: service_account.Credentials):
+    df = get_df_from_gbq(TABLE_NAMES[url], credentials=credentials)
+    df, y_df = normalize_dataset(url, df)
+    df_result = experiment_local(url=url, X_df=df, y_df=y_df, boost=boost,
+                                 depth=depth, reg_lambda=reg_lambda, learning_rate=learning_rate, num_rounds=num_rounds)
+    logger.info(f'{url} by {boost}\n{df_result}')
+
+
+def run_sweep(exp: dict, client: Client, name: str, credentials=None, resume: bool = False, n_workers: int = None):
+    """
+    Place each dataset's trials on home workers, scatter each dataset to its home workers only, and then run the
+    trials longest first. The workers that join later are homed as the sweep runs.
+    :param name: The driver's name, e.g. 'xyz_ems', which names its saved cost model.
+    :param n_workers: The workers requested, e.g. the SLURM jobs; waited for, see `await_workers()`, before placing.
+    """
+    if n_workers is not None:
+        await_workers(client, n_workers)
+    cost_model = CostModel(COST_PRIOR, path=cost_model_path(name))
+    homes = {}
+
+    def place(stats: dict) -> dict:
+        rows = {key: s['rows'] for key, s in stats.items()}
+        homes.update(plan_homes(exp, client, cost_model, lambda params: cost_features(params, rows),
+                                group=lambda params: params['url'], held=held_datasets))
+        return homes
+
+    stats = push_tables_to_cluster(TABLE_NAMES, client, credentials=credentials, workers=place)
+    push_thread_budget(client)
+    rows = {key: s['rows'] for key, s in stats.items()}
+    do_on_cluster_longest_first(exp, experiment, client, cost_model,
+                                lambda params: cost_features(params, rows), credentials=credentials,
+                                group=lambda params: params['url'], held=held_datasets, homes=homes,
+                                resume=resume, key_columns=RESULT_KEYS, trial_keys=result_keys,
+                                memo=memo_cache(memo_salt(stats)))
+
+
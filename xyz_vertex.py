@@ -1,24 +1,18 @@
 #!/usr/bin/env python3
 
 import logging
-from pathlib import Path
 import argparse
 from tornado.ioloop import IOLoop
 import numpy as np
-from sklearn.metrics import accuracy_score
-from sklearn.preprocessing import LabelEncoder
-from sklearn.model_selection import train_test_split
-import xgboost as xgb
-import catboost
-import lightgbm as lgb
-import pandas as pd
 from pandas import DataFrame
 
 from dask.distributed import LocalCluster, Client
 from dask_jobqueue import SLURMCluster
-from google.cloud import bigquery
 from google.oauth2 import service_account
-from EMS.manager import EvalOnCluster, get_gbq_credentials, get_dataset, do_on_cluster
+from memo_cache import memo_cache
+from thread_budget import push_thread_budget
+from xyz_study import StudyBOOST, StudyURL, TABLE_NAMES, push_tables_to_cluster, memo_salt, experiment, run_sweep
+from EMS.manager import EvalOnCluster, get_gbq_credentials
 
 from google.cloud import aiplatform
 from google.cloud.aiplatform.vizier import pyvizier as vz
@@ -30,175 +24,9 @@ logging.getLogger('LightGBM').setLevel(logging.WARNING)
 logger = logging.getLogger()
 
 
-class StudyBOOST:
-    XGBOOST = 'xgboost'
-    CATBOOST = 'catboost'
-    LIGHTGBM = 'lightgbm'
-
-
-class StudyURL:
-    """
-    Let’s do these four datasets:
-    1) Adult Income: https://archive.ics.uci.edu/dataset/2/adult
-    2) California housing: https://www.kaggle.com/datasets/camnugent/california-housing-prices
-    3) Forest Covertype: https://archive.ics.uci.edu/dataset/31/covertype
-    4) Higgs: https://www.kaggle.com/c/higgs-boson
-    """
-    UCIML_ADULT_INCOME = 'https://archive.ics.uci.edu/dataset/2/adult'
-    KAGGLE_CALIFORNIA_HOUSING_PRICES = 'https://www.kaggle.com/datasets/camnugent/california-housing-prices'
-    UCIML_FOREST_COVERTYPE = 'https://archive.ics.uci.edu/dataset/31/covertype'
-    KAGGLE_HIGGS_BOSON = 'https://www.kaggle.com/c/higgs-boson/'
-    KAGGLE_HIGGS_BOSON_TRAINING = 'https://www.kaggle.com/c/higgs-boson/training'
-    KAGGLE_HIGGS_BOSON_TEST = 'https://www.kaggle.com/c/higgs-boson/test'
-
-
-TABLE_NAMES = {  # URL to GBQ table name map.
-    StudyURL.UCIML_ADULT_INCOME: 'XYZ.adult_income',
-    StudyURL.KAGGLE_CALIFORNIA_HOUSING_PRICES: 'XYZ.california_housing_prices',
-    StudyURL.UCIML_FOREST_COVERTYPE: 'XYZ.forest_covertype',
-    StudyURL.KAGGLE_HIGGS_BOSON_TRAINING: 'XYZ.higgs_boson_training',
-    StudyURL.KAGGLE_HIGGS_BOSON_TEST: 'XYZ.higgs_boson_test',
-}
-
-
-def get_df_from_gbq(table_name, credentials: service_account.Credentials = None):
-    client = bigquery.Client(credentials=credentials)
-    query = f"SELECT * FROM `{table_name}`"
-    df = client.query(query).to_dataframe()
-    return df
-
-
-def push_tables_to_cluster(tables: dict, c: Client, credentials: service_account.Credentials = None):
-    for key, table in tables.items():
-        df = get_df_from_gbq(table, credentials)
-        c.publish_dataset(df, name=key)
-        logger.info(f'{key}\n{df}')
-
-
-def push_tables_to_filesystem(tables: dict, path: Path, credentials: service_account.Credentials = None):
-    for key, table in tables.items():
-        df = get_df_from_gbq(table, credentials)
-        filename = table + '.parquet'
-        p = path / filename
-        df.to_parquet(path=p)
-        logger.info(f'{key}\n{df}')
-
-
-DATASETS = {}
-
-
-def get_local_dataset(key: str) -> DataFrame:
-    df = DATASETS.get(key, None)
-    if df is None:
-        df = get_dataset(key)
-        DATASETS[key] = df
-    return df.copy(deep=True)  # Defend against mutating common data.
-
-
-# Objective functions to maximize.
-def experiment_local(*, url: str, X_df: DataFrame, y_df: DataFrame, boost: str,
-                     depth: int, reg_lambda: float, learning_rate: float, num_rounds: int) -> DataFrame:
-    logger.warning(f'url: {url}; boost: {boost}\n{depth}, {reg_lambda}, {learning_rate}, {num_rounds}')
-    # Create data array
-    X = X_df.values
-
-    # Convert y into target array
-    y_array = y_df.iloc[:, 0].to_numpy()
-
-    # Create target vector
-    if np.issubdtype(y_array.dtype, np.number):
-        y = y_array
-        num_classes = 1
-        obj_type = 'reg'
-    else:
-        # If y is categorical (including strings), use LabelEncoder for encoding
-        encoder = LabelEncoder()
-        y = encoder.fit_transform(y_array)
-        num_classes = len(encoder.classes_)
-        obj_type = 'bin' if num_classes == 2 else 'mult'
-
-    # Split into train and test
-    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2)
-
-    match boost:
-        case StudyBOOST.XGBOOST:
-            xgb_params = {'learning_rate': learning_rate, 'reg_lambda': reg_lambda,
-                          'max_depth': depth, 'n_estimators': num_rounds}
-            match obj_type:
-                case 'reg':
-                    xgb_params['objective'] = 'reg:squarederror'
-                case 'bin':
-                    xgb_params['objective'] = 'binary:logistic'
-                case 'mult':
-                    xgb_params['objective'] = 'multi:softprob'
-                    xgb_params['num_classes'] = num_classes
-            model = xgb.XGBRegressor(**xgb_params) if obj_type == 'reg' else xgb.XGBClassifier(**xgb_params)
-        case StudyBOOST.CATBOOST:
-            model = catboost.CatBoostClassifier(learning_rate=learning_rate,
-                                                l2_leaf_reg=reg_lambda,
-                                                depth=depth,
-                                                iterations=num_rounds,
-                                                silent=True)
-        case StudyBOOST.LIGHTGBM:
-            model = lgb.LGBMClassifier(learning_rate=learning_rate,
-                                       lambda_l2=reg_lambda,
-                                       max_depth=depth,
-                                       n_estimators=num_rounds,
-                                       verbose=-1)
-        case _:
-            raise Exception("Invalid Method Name!")
-    model.fit(X_train, y_train)
-
-    # Make predictions on the test set
-    test_preds = model.predict(X_test)
-    test_predictions = [1 if x > 0.5 else 0 for x in test_preds]
-    test_accuracy = accuracy_score(y_test, test_predictions)
-
-    return DataFrame(data={'url': url, 'boost': boost, 'depth': depth,
-                           'reg_lambda': reg_lambda, 'learning_rate': learning_rate, 'num_rounds': num_rounds,
-                           'test_accuracy': test_accuracy},
-                     index=[0])
-
-
-def category_encode(df: DataFrame) -> DataFrame:
-    # Select object columns
-    object_cols = df.select_dtypes(include='object').columns
-
-    # One-shot encode these columns
-    df_encoded = pd.get_dummies(df, columns=object_cols)
-
-    # Preview
-    logger.info(f'{df_encoded.head()}')
-
-    return df_encoded
-
-
-def normalize_dataset(url: str, df: DataFrame) -> (DataFrame, DataFrame):
-    match url:
-        case StudyURL.UCIML_ADULT_INCOME:
-            y_df = df[['income']]
-            X_df = df.drop('income', axis=1)
-        case StudyURL.KAGGLE_CALIFORNIA_HOUSING_PRICES:
-            y_df = df[['median_house_value']]
-            X_df = df.drop('median_house_value', axis=1)
-        case StudyURL.UCIML_FOREST_COVERTYPE:
-            y_df = df[['Cover_Type']]
-            X_df = df.drop('Cover_Type', axis=1)
-        case StudyURL.KAGGLE_HIGGS_BOSON_TRAINING | StudyURL.KAGGLE_HIGGS_BOSON_TEST:
-            y_df = df[['Label']]
-            X_df = df.drop('Label', axis=1)
-        case _:
-            raise Exception("Invalid Dataset Name!")
-    X_df = category_encode(X_df)
-    return X_df, y_df
-
-
-def experiment(*, url: str, boost: str,
-               depth: int, reg_lambda: float, learning_rate: float, num_rounds: int) -> DataFrame:
-    df = get_local_dataset(url)
-    df, y_df = normalize_dataset(url, df)
-    return experiment_local(url=url, X_df=df, y_df=y_df, boost=boost,
-                            depth=depth, reg_lambda=reg_lambda, learning_rate=learning_rate, num_rounds=num_rounds)
+"""
+A Vertex AI Vizier study of the XYZ study in `xyz_study.py`.
+"""
 
 
 def get_vertex_study(study_id: str = 'xyz_example',
@@ -232,35 +60,75 @@ def get_vertex_study(study_id: str = 'xyz_example',
 
 
 async def calc_xyz_vertex_on_cluster_async(table_name: str, client: Client,
-                                           nodes: int, credentials: service_account.Credentials):
+                                           nodes: int, credentials: service_account.Credentials, salt: str = None):
+    """
+    :param salt: From `memo_salt()`; without it the memo cache is not used.
+    """
 
     MAX_NUM_ITERATIONS = 6 * 10 + 2 * nodes  # Sagi Perel suggestion. Less than the 360 used in EMS example.
     study = get_vertex_study(study_id=table_name, credentials=credentials)
     ec = EvalOnCluster(client, table_name, credentials=credentials)
-    in_cluster = {}
+    memo = None if salt is None else memo_cache(salt)
+    in_cluster = {}  # Key to the suggestions awaiting its computation; duplicates share one.
+    measured = {}  # Key to the test accuracy of every completed computation.
+    dispatched_params = {}  # Key to the params in the cluster, to memoize their results.
+    completed = 0
+
+    def complete(suggestion, accuracy: float):
+        nonlocal completed
+        completed += 1
+        if np.isnan(accuracy):  # A regression objective; `metrics()` reports no accuracy.
+            suggestion.complete(infeasible_reason='test_accuracy is undefined for a regression objective.')
+            return
+        measurement = vz.Measurement()
+        measurement.metrics['test_accuracy'] = accuracy
+        suggestion.add_measurement(measurement=measurement)
+        suggestion.complete(measurement=measurement)
 
     def push_suggestions_to_cluster(count):
-        logger.info(f'Call Vizier.')
-        for suggestion in study.suggest(count=count):
-            params = suggestion.materialize().parameters.as_dict()
-            params['depth'] = round(params['depth'])
-            params['num_rounds'] = round(params['num_rounds'])
-            key = ec.key_from_params(params)
-            if not in_cluster.get(key, None):  # Defend against duplicate computation.
-                logger.info(f'EC Key: {key}\nParams: {params}')
-                key = ec.eval_params(experiment, params)
-                in_cluster[key] = suggestion
+        """
+        Dispatch up to `count` new computations. A suggestion already measured, in this study or in the memo cache,
+        is completed at once; one already in the cluster waits on its computation. Ask Vizier again, a few times,
+        while its suggestions dispatch nothing new, so the cluster does not drain.
+        """
+        dispatched = 0
+        for _ in range(3):
+            logger.info(f'Call Vizier.')
+            for suggestion in study.suggest(count=count - dispatched):
+                params = suggestion.materialize().parameters.as_dict()
+                params['depth'] = round(params['depth'])
+                params['num_rounds'] = round(params['num_rounds'])
+                key = ec.key_from_params(params)
+                if key not in measured and memo is not None:
+                    df = memo.get(experiment, params)
+                    if df is not None:
+                        ec.db.push(df)  # An EMS `Databases`, not a `Sink`.
+                        measured[key] = df.iloc[0]['test_accuracy']
+                if key in measured:
+                    logger.info(f'Measured Key: {key}')
+                    complete(suggestion, measured[key])
+                elif key in in_cluster:
+                    logger.info(f'Pending Key: {key}')
+                    in_cluster[key].append(suggestion)
+                else:
+                    logger.info(f'EC Key: {key}\nParams: {params}')
+                    in_cluster[ec.eval_params(experiment, params)] = [suggestion]
+                    dispatched_params[key] = params
+                    dispatched += 1
+            if dispatched > 0 or completed >= MAX_NUM_ITERATIONS:
+                break
         logger.info(f'Pending computations: {len(in_cluster)}.')
 
     def push_result_to_vertex(df: DataFrame, key: tuple):
         logger.info(f'Push result to Vizier, EC Key: {key}')
-        measurement = vz.Measurement()
-        measurement.metrics['test_accuracy'] = df.iloc[0]['test_accuracy']
-        suggestion = in_cluster.get(key, None)
-        if suggestion is not None:
-            suggestion.add_measurement(measurement=measurement)
-            suggestion.complete(measurement=measurement)
-            del in_cluster[key]
+        measured[key] = df.iloc[0]['test_accuracy']
+        params = dispatched_params.pop(key, None)
+        if memo is not None and params is not None:
+            memo.put(experiment, params, df)
+        suggestions = in_cluster.pop(key, None)
+        if suggestions is not None:
+            for suggestion in suggestions:
+                complete(suggestion, measured[key])
         else:
             logger.info(f'Key problem: {key}\n{in_cluster}')
         logger.info(f'End Push.')
@@ -274,8 +142,8 @@ async def calc_xyz_vertex_on_cluster_async(table_name: str, client: Client,
         await IOLoop.current().run_in_executor(None, push_result_to_vertex, df, key)
         i += 1
         active_suggestions = len(in_cluster)
-        logger.info(f'Completed computations: {i}; Pending: {active_suggestions}.')
-        if i < MAX_NUM_ITERATIONS:
+        logger.info(f'Completed computations: {i}; Trials: {completed}; Pending: {active_suggestions}.')
+        if completed < MAX_NUM_ITERATIONS:
             # push_suggestions_to_cluster(nodes)
             await IOLoop.current().run_in_executor(None, push_suggestions_to_cluster, nodes)
         else:
@@ -292,6 +160,7 @@ def setup_xyz_vertex_on_local_node(table_name: str, credentials: service_account
     with LocalCluster() as lc, Client(lc) as client:
         logger.info(f'Local cluster: {lc}, Client: {client}')
         push_tables_to_cluster(TABLE_NAMES, client, credentials=credentials)
+        push_thread_budget(client)
         nthreads = sum(w.nthreads for w in lc.workers.values())
         calc_xyz_vertex_on_cluster(table_name, client, nthreads, credentials)
 
@@ -301,9 +170,10 @@ async def setup_xyz_vertex_on_local_node_async(table_name: str, credentials: ser
     # lc = LocalCluster(n_workers=1, threads_per_worker=2)
     client = await Client(lc, asynchronous=True)
     logger.info(f'Local cluster: {lc}, Client: {client}')
-    push_tables_to_cluster(TABLE_NAMES, client, credentials=credentials)
+    stats = await push_tables_to_cluster(TABLE_NAMES, client, credentials=credentials)
+    await push_thread_budget(client)
     nthreads = sum(w.nthreads for w in lc.workers.values())
-    await calc_xyz_vertex_on_cluster_async(table_name, client, nthreads, credentials)
+    await calc_xyz_vertex_on_cluster_async(table_name, client, nthreads, credentials, memo_salt(stats))
     client.close()
     lc.close()
 
@@ -315,6 +185,7 @@ def setup_xyz_vertex_on_cluster(table_name: str, credentials: service_account.Cr
         logging.info(cluster.job_script())
         with Client(cluster) as client:
             push_tables_to_cluster(TABLE_NAMES, client, credentials=credentials)
+            push_thread_budget(client)
             calc_xyz_vertex_on_cluster(table_name, client, nodes, credentials)
         cluster.scale(0)
 
@@ -325,8 +196,9 @@ async def setup_xyz_vertex_on_cluster_async(table_name: str, credentials: servic
     cluster.scale(jobs=nodes)
     logging.info(cluster.job_script())
     client = await Client(cluster, asynchronous=True)
-    push_tables_to_cluster(TABLE_NAMES, client, credentials=credentials)
-    await calc_xyz_vertex_on_cluster_async(table_name, client, nodes, credentials)
+    stats = await push_tables_to_cluster(TABLE_NAMES, client, credentials=credentials)
+    await push_thread_budget(client)
+    await calc_xyz_vertex_on_cluster_async(table_name, client, nodes, credentials, memo_salt(stats))
     client.close()
     cluster.scale(0)
     cluster.close()
@@ -363,32 +235,21 @@ def create_config(su_id: str = 'su_id') -> dict:
     return ems_spec
 
 
-def setup_experiment(url: str, boost: str, depth: int, reg_lambda: float, learning_rate: float, num_rounds: int,
-                     credentials: service_account.Credentials):
-    df = get_df_from_gbq(TABLE_NAMES[url], credentials=credentials)
-    df, y_df = normalize_dataset(url, df)
-    df_result = experiment_local(url=url, X_df=df, y_df=y_df, boost=boost,
-                                 depth=depth, reg_lambda=reg_lambda, learning_rate=learning_rate, num_rounds=num_rounds)
-    logger.info(f'{url} by {boost}\n{df_result}')
-
-
-def do_cluster_experiment(su_id: str = 'su_ID', credentials=None):
+def do_cluster_experiment(su_id: str = 'su_ID', credentials=None, resume: bool = False):
     exp = create_config(su_id=su_id)
     nodes = 8
     with SLURMCluster(cores=1, memory='4GiB', processes=1, walltime='24:00:00') as cluster:
         cluster.scale(jobs=nodes)
         logging.info(cluster.job_script())
         with Client(cluster) as client:
-            push_tables_to_cluster(TABLE_NAMES, client, credentials=credentials)
-            do_on_cluster(exp, experiment, client, credentials=credentials)
+            run_sweep(exp, client, 'xyz_vertex', credentials=credentials, resume=resume, n_workers=nodes)
         cluster.scale(0)
 
 
-def do_local_experiment(su_id: str = 'su_ID', credentials=None):
+def do_local_experiment(su_id: str = 'su_ID', credentials=None, resume: bool = False):
     exp = create_config(su_id=su_id)
     with LocalCluster() as lc, Client(lc) as client:
-        push_tables_to_cluster(TABLE_NAMES, client, credentials=credentials)
-        do_on_cluster(exp, experiment, client, credentials=credentials)
+        run_sweep(exp, client, 'xyz_vertex', credentials=credentials, resume=resume)
 
 
 def do_vertex_on_local_async(table_name: str, credentials=None):